@@ -0,0 +1,43 @@
+"""
+Time `S2TConverter` against opencc's s2t converter. That both give the
+same output is checked by tests/test_converter.py.
+
+Usage:
+    python -m benchmarks.bench_s2t
+"""
+
+import timeit
+
+import opencc
+
+from src.converter import S2TConverter
+
+SAMPLE = (
+    '听起来你今天真的很累，辛苦了。工作上的压力有时候会让人喘不过气，'
+    '这种感觉是很正常的，不代表你不够好。\n\n'
+    '如果愿意的话，可以跟我说说今天发生了什么事吗？是不是有哪件事情让你特别在意？'
+    '有时候把心里的话说出来，会觉得轻松一点。\n\n'
+    '另外，也记得给自己一点休息的时间：喝杯温水、听听喜欢的音乐，或是早点睡觉。'
+    '你已经很努力了，对自己温柔一点也没关系。我会一直在这里陪你。'
+)
+
+
+def main():
+    reference = opencc.OpenCC('s2t')
+    converter = S2TConverter()
+    uncached_converter = S2TConverter(cache_size=0)
+
+    for name, text in (('reply (~250 chars)', SAMPLE),
+                       ('long reply (~2500 chars)', SAMPLE * 10),
+                       ('ascii only', 'I hear you, that sounds exhausting. ' * 10)):
+        number = 200
+        old = min(timeit.repeat(lambda: reference.convert(text), number=number, repeat=3)) / number
+        uncached = min(timeit.repeat(
+            lambda: uncached_converter.convert(text), number=number, repeat=3)) / number
+        new = min(timeit.repeat(lambda: converter.convert(text), number=number, repeat=3)) / number
+        print(f'{name:>26}: opencc {old * 1e3:8.3f} ms  '
+              f'uncached {uncached * 1e3:8.3f} ms  cached {new * 1e3:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Cold-start cost of main.py: the time to import it in a fresh interpreter,
+the slowest modules it imports, and the time from starting the import to
+the first reply, against the stand-ins of `benchmarks.load_test`.
+
+Usage:
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 10 --budget 0.5
+
+Exits with status 1 when the median import time exceeds --budget seconds.
+Needs moto (pip install moto) for the time to first reply.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASE_ENV = {
+    'LINE_CHANNEL_SECRET': 'load-test-channel-secret',
+    'LINE_CHANNEL_ACCESS_TOKEN': 'load-test-token',
+    'DEFAULT_API_KEY': 'sk-load-test',
+    'OPENAI_MODEL_ENGINE': 'gpt-3.5-turbo',
+    'SYSTEM_MESSAGE': '你是一個溫暖的傾聽者。',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+}
+
+
+def _child_import():
+    # pylint: disable=import-outside-toplevel,unused-import
+    import time
+    started_at = time.perf_counter()
+    import main  # noqa: F401
+    print(json.dumps({'import': time.perf_counter() - started_at}))
+
+
+def _child_first_reply():
+    # Stand-ins are set up before the clock starts, moto has imported boto3 by then.
+    # pylint: disable=import-outside-toplevel
+    import time
+    from moto import mock_aws
+    from benchmarks import load_test
+
+    replies = {}
+    openai_server = load_test.start_fake_openai(0.0, 0.0, 0.0)
+    line_server = load_test.start_fake_line(replies)
+    with mock_aws():
+        load_test.create_log_table()
+        body, signature, reply_token = load_test.make_webhook('U' + '0' * 32, '我好累')
+
+        started_at = time.perf_counter()
+        import main
+        imported_at = time.perf_counter()
+        main.model_management.default_model.base_url = \
+            f'http://127.0.0.1:{openai_server.server_address[1]}/v1'
+        main.line_bot_api.endpoint = f'http://127.0.0.1:{line_server.server_address[1]}'
+        response = main.app.test_client().post(
+            '/callback', data=body.encode('utf-8'), headers={'X-Line-Signature': signature})
+        while reply_token not in replies and time.perf_counter() - started_at < 30:
+            time.sleep(0.001)
+        print(json.dumps({
+            'status': response.status_code,
+            'import': imported_at - started_at,
+            'first_reply': replies.get(reply_token, float('nan')) - started_at,
+        }))
+
+
+def _run_child(mode: str, extra_args=(), env=None) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *extra_args, '-m', 'benchmarks.bench_startup', '--child', mode],
+        env={**os.environ, **BASE_ENV, **(env or {})},
+        capture_output=True, text=True, check=True)
+
+
+def _last_json(output: str) -> dict:
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(count: int):
+    """
+    The modules with the largest cumulative import time under `-X importtime`.
+    """
+    result = _run_child('import', ['-X', 'importtime'])
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only the modules main imports directly, nested ones are part of those.
+        if name.startswith('   ') and not name.startswith('    '):
+            rows.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per measurement.')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports listed.')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Fail when the median import time exceeds this many seconds.')
+    parser.add_argument('--child', choices=('import', 'first_reply'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child == 'import':
+        _child_import()
+        return 0
+    if args.child == 'first_reply':
+        _child_first_reply()
+        return 0
+
+    imports = [_last_json(_run_child('import').stdout)['import'] for _ in range(args.runs)]
+    print(f'import main:         median {statistics.median(imports) * 1000:.1f} ms  '
+          f'min {min(imports) * 1000:.1f} ms  ({args.runs} runs)')
+
+    print('slowest imports:')
+    for seconds, name in slowest_imports(args.top):
+        print(f'  {seconds * 1000:8.1f} ms  {name}')
+
+    try:
+        replies = [_last_json(_run_child('first_reply').stdout) for _ in range(args.runs)]
+    except subprocess.CalledProcessError as error:
+        print(f'time to first reply: skipped ({error.stderr.strip().splitlines()[-1]})')
+    else:
+        first = [reply['first_reply'] for reply in replies]
+        print(f'time to first reply: median {statistics.median(first) * 1000:.1f} ms  '
+              f'min {min(first) * 1000:.1f} ms  (status {replies[0]["status"]}, '
+              'import included, boto3 preloaded by moto)')
+
+    if args.budget is not None and statistics.median(imports) > args.budget:
+        print(f'import time over the budget of {args.budget * 1000:.0f} ms')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
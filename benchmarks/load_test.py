@@ -0,0 +1,320 @@
+"""
+Load test of main.py against local stand-ins: a fake OpenAI server with
+configurable latency and error rate, a fake LINE messaging API, and
+DynamoDB mocked by moto. Signed LINE webhooks are replayed against the
+app served by werkzeug, and the throughput, latency percentiles of the
+webhook and of the reply, and RSS over time are reported.
+
+Usage:
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --requests 2000 --concurrency 32 --openai-latency 0.5
+    python -m benchmarks.load_test --env WEBHOOK_DISPATCH_MODE=async --env DYNAMODB_LOG_MODE=buffered
+
+Needs moto (pip install moto).
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import requests
+from moto import mock_aws
+from werkzeug.serving import make_server
+
+CHANNEL_SECRET = 'load-test-channel-secret'
+
+PROMPTS = [
+    '我好累', 'hi', '你好', '今天工作好煩，老闆一直找我麻煩', '睡不著',
+    '我覺得沒有人懂我', '最近壓力好大，不知道該怎麼辦才好', '謝謝你',
+]
+
+REPLY = (
+    '听起来你今天真的很累，辛苦了。工作上的压力有时候会让人喘不过气，'
+    '这种感觉是很正常的。如果愿意的话，可以跟我说说今天发生了什么事吗？'
+)
+
+
+def rss_bytes() -> int:
+    """
+    Resident set size of this process, the peak RSS where /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm', encoding='ascii') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_fake_openai(latency: float, jitter: float, error_rate: float) -> ThreadingHTTPServer:
+    """
+    Chat completions answered after `latency` ± `jitter` seconds, failing
+    with a 500 at `error_rate`.
+    """
+
+    class Handler(_QuietHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            self._send_json(200, {'data': []})
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            body = self._read_json()
+            time.sleep(max(0.0, random.gauss(latency, jitter)))
+            if random.random() < error_rate:
+                self._send_json(500, {'error': {'message': 'The server had an error.'}})
+                return
+            usage = {'prompt_tokens': 20 * len(body.get('messages', [])), 'completion_tokens': 80}
+            if not body.get('stream'):
+                self._send_json(200, {
+                    'choices': [{'message': {'role': 'assistant', 'content': REPLY}}],
+                    'usage': usage
+                })
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for start in range(0, len(REPLY), 8):
+                chunk = {'choices': [{'delta': {'content': REPLY[start:start + 8]}}]}
+                self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.write(f'data: {json.dumps({"choices": [], "usage": usage})}\n\n'.encode('utf-8'))
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.close_connection = True
+
+    return _serve(Handler)
+
+
+def start_fake_line(replies: dict) -> ThreadingHTTPServer:
+    """
+    The reply and push endpoints of the LINE messaging API, recording when
+    the first message for every reply token (or user, when pushed) came in.
+    """
+    lock = threading.Lock()
+
+    class Handler(_QuietHandler):
+        def do_POST(self):  # pylint: disable=invalid-name
+            body = self._read_json()
+            key = body.get('replyToken') or body.get('to')
+            with lock:
+                replies.setdefault(key, time.perf_counter())
+            self._send_json(200, {})
+
+    return _serve(Handler)
+
+
+def _serve(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _url(server) -> str:
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def create_log_table():
+    boto3.resource('dynamodb', region_name='us-west-1').create_table(
+        TableName='user_log',
+        KeySchema=[
+            {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST')
+
+
+def make_webhook(user_id: str, text: str):
+    """
+    A signed webhook with one text message event.
+
+    Returns:
+        Tuple of the body (str), its signature (str) and the reply token (str).
+    """
+    reply_token = uuid.uuid4().hex
+    body = json.dumps({
+        'destination': 'Uload-test',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': int(time.time() * 1000),
+            'webhookEventId': uuid.uuid4().hex,
+            'deliveryContext': {'isRedelivery': False},
+            'source': {'type': 'user', 'userId': user_id},
+            'replyToken': reply_token,
+            'message': {'type': 'text', 'id': uuid.uuid4().hex, 'text': text},
+        }]
+    }, ensure_ascii=False)
+    digest = hmac.new(CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return body, base64.b64encode(digest).decode('ascii'), reply_token
+
+
+def run(args):
+    replies = {}
+    openai_server = start_fake_openai(args.openai_latency, args.openai_jitter, args.openai_error_rate)
+    line_server = start_fake_line(replies)
+
+    os.environ.update({
+        'LINE_CHANNEL_SECRET': CHANNEL_SECRET,
+        'LINE_CHANNEL_ACCESS_TOKEN': 'load-test-token',
+        'DEFAULT_API_KEY': 'sk-load-test',
+        'OPENAI_MODEL_ENGINE': 'gpt-3.5-turbo',
+        'SYSTEM_MESSAGE': '你是一個溫暖的傾聽者。',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+    })
+    for item in args.env:
+        key, _, value = item.partition('=')
+        os.environ[key] = value
+
+    with mock_aws():
+        create_log_table()
+        # pylint: disable=import-outside-toplevel
+        import main
+        # Dropped jobs and failed turns show up in the status codes and reply counts.
+        main.logger.setLevel(logging.ERROR)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        main.model_management.default_model.base_url = f'{_url(openai_server)}/v1'
+        main.line_bot_api.endpoint = _url(line_server)
+
+        app_server = make_server('127.0.0.1', 0, main.app, threaded=True)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+        callback_url = f'http://127.0.0.1:{app_server.server_port}/callback'
+
+        users = [f'U{index:032x}' for index in range(args.users)]
+        payloads = [make_webhook(random.choice(users), random.choice(PROMPTS))
+                    for _ in range(args.requests)]
+
+        rss_samples = [(0.0, rss_bytes())]
+        done = threading.Event()
+        started_at = time.perf_counter()
+
+        def sample_rss():
+            while not done.wait(args.sample_interval):
+                rss_samples.append((time.perf_counter() - started_at, rss_bytes()))
+
+        threading.Thread(target=sample_rss, daemon=True).start()
+
+        local = threading.local()
+        sent_at, latencies, statuses = {}, [], {}
+        lock = threading.Lock()
+
+        def post(payload):
+            body, signature, reply_token = payload
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            start = time.perf_counter()
+            sent_at[reply_token] = start
+            response = session.post(
+                callback_url, data=body.encode('utf-8'),
+                headers={'X-Line-Signature': signature, 'Content-Type': 'application/json'})
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(post, payloads))
+        sent_duration = time.perf_counter() - started_at
+
+        # Async dispatch and debouncing answer after the webhook returned. Messages
+        # answered together get one reply, so stop once replies stop coming in.
+        deadline = time.perf_counter() + args.drain_timeout
+        received, quiet_since = -1, time.perf_counter()
+        while len(replies) < len(sent_at) and time.perf_counter() < deadline:
+            if len(replies) != received:
+                received, quiet_since = len(replies), time.perf_counter()
+            elif time.perf_counter() - quiet_since > args.drain_quiet:
+                break
+            time.sleep(0.05)
+        done.set()
+        rss_samples.append((time.perf_counter() - started_at, rss_bytes()))
+
+        reply_latencies = [replies[token] - start for token, start in sent_at.items() if token in replies]
+        app_server.shutdown()
+
+    report(args, sent_duration, latencies, reply_latencies, statuses, rss_samples)
+
+
+def report(args, duration, latencies, reply_latencies, statuses, rss_samples):
+    print(f'requests:        {args.requests} with concurrency {args.concurrency}, {args.users} users')
+    print(f'openai:          latency {args.openai_latency}s ± {args.openai_jitter}s, '
+          f'error rate {args.openai_error_rate:.0%}')
+    print(f'env:             {" ".join(args.env) or "(defaults)"}')
+    print(f'status codes:    {dict(sorted(statuses.items()))}')
+    print(f'throughput:      {len(latencies) / duration:.1f} req/s over {duration:.2f}s')
+    for name, values in (('webhook', latencies), ('reply', reply_latencies)):
+        print(f'{name + " latency:":<17}'
+              f'p50 {percentile(values, 0.50) * 1000:.1f} ms  '
+              f'p95 {percentile(values, 0.95) * 1000:.1f} ms  '
+              f'p99 {percentile(values, 0.99) * 1000:.1f} ms  '
+              f'mean {statistics.fmean(values) * 1000 if values else 0:.1f} ms  '
+              f'({len(values)} samples)')
+    print('rss:')
+    for elapsed, rss in rss_samples:
+        print(f'  {elapsed:7.2f}s  {rss / 1024 / 1024:8.1f} MiB')
+    growth = rss_samples[-1][1] - rss_samples[0][1]
+    print(f'rss growth:      {growth / 1024 / 1024:+.1f} MiB')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--requests', type=int, default=500, help='Webhooks to send.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Webhooks in flight.')
+    parser.add_argument('--users', type=int, default=100, help='Distinct LINE users.')
+    parser.add_argument('--openai-latency', type=float, default=0.2, help='Seconds per completion.')
+    parser.add_argument('--openai-jitter', type=float, default=0.05, help='Std dev of the latency.')
+    parser.add_argument('--openai-error-rate', type=float, default=0.0, help='Share of failed completions.')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between RSS samples.')
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='Seconds to wait for replies still being handled.')
+    parser.add_argument('--drain-quiet', type=float, default=2.0,
+                        help='Stop waiting after this many seconds without a new reply.')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Environment for main.py, e.g. WEBHOOK_DISPATCH_MODE=async.')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,72 @@
+"""
+gunicorn.conf.py
+
+    gunicorn -c gunicorn.conf.py main:app
+
+The app is not preloaded: every worker process imports main.py after the
+fork, so `memory`, `model_management`, the DynamoDB handler, the MongoDB
+client and the background threads all belong to a single worker. Within
+a worker they are shared by its threads and are thread-safe. With more
+than one worker, set MEMORY_BACKEND=mongo (and RATE_LIMIT_STORE=mongo) so
+conversations and rate limits are shared between them.
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+
+bind = f"0.0.0.0:{os.getenv('APP_PORT', '8080')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))
+# Completions can take a while, a worker is only killed when it hangs much longer.
+timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+preload_app = False
+accesslog = None
+
+
+def post_worker_init(worker):
+    """
+    Warm up in the background so the worker can take requests right away.
+    WARM_UP=false leaves everything to the first message.
+
+    Also start draining as soon as the worker is asked to stop: by the
+    time `worker_exit` runs, gunicorn already closed the listeners and
+    finished the requests in flight.
+    """
+    main = sys.modules.get('main')
+    if main is None:
+        return
+    if os.getenv('WARM_UP', 'true').lower() == 'true':
+        threading.Thread(target=main.warm_up, name='warm-up', daemon=True).start()
+
+    def draining(handle):
+        def handle_signal(signum, frame):
+            if not main.draining.is_set():
+                # The arbiter kills the worker `graceful_timeout` seconds after signalling it.
+                worker.exit_deadline = time.monotonic() + graceful_timeout
+                main.draining.set()
+            handle(signum, frame)
+        return handle_signal
+
+    signal.signal(signal.SIGTERM, draining(worker.handle_exit))
+    signal.signal(signal.SIGQUIT, draining(worker.handle_quit))
+    signal.signal(signal.SIGINT, draining(worker.handle_quit))
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """
+    Drain the queued webhook events and buffered logs before the worker
+    exits, within what is left of the graceful timeout.
+    """
+    main = sys.modules.get('main')
+    if main is not None:
+        deadline = getattr(worker, 'exit_deadline', None)
+        timeout = graceful_timeout if deadline is None else deadline - time.monotonic()
+        # Leave a moment for the memory snapshot before the arbiter's SIGKILL.
+        main.shutdown(timeout=max(0, timeout - 1))
@@ -2,6 +2,7 @@
 DocString.
 """
 import os
+import threading
 import time
 
 from dotenv import load_dotenv
@@ -9,44 +10,218 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask import \
     Flask, request, abort, render_template, flash, url_for, \
-    send_from_directory, Markup, send_file, redirect, session
-import boto3
+    send_from_directory, send_file, redirect, session, jsonify, Response
 
-from linebot import (
-    LineBotApi, WebhookHandler
-)
+from linebot import LineBotApi
 from linebot.exceptions import (
-    InvalidSignatureError
+    InvalidSignatureError, LineBotApiError
 )
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, AudioMessage, ImageMessage
 )
 
-from src.models import OpenAIModel, DynamoDBLogHandler
-from src.memory import Memory
-from src.logger import logger
-from src.utils import get_role_and_content
+from src.models import DynamoDBLogHandler, format_timestamp
+from src.dispatcher import EventDispatcher
+from src.webhook import WebhookHandler
+from src.transport import HTTPTransport
+from src.registry import ModelRegistry
+from src.ratelimit import RateLimiter, MemoryLimiterStore, MongoLimiterStore
+from src.coalesce import TurnCoalescer
+from src.dedup import EventDeduplicator, MemorySeenStore, MongoSeenStore
+from src.response_cache import ResponseCache, MemoryResponseStore, MongoResponseStore
+from src.memory import Memory, MongoMemory
+from src.summarize import Summarizer
+from src.metrics import metrics
+from src.mongodb import mongodb
+from src.storage import Storage, FileStorage, MongoStorage
+from src.tokens import parse_token_budgets
+from src.logger import logger, configure_logger
+from src.utils import \
+    get_role_and_content, get_s2t_converter, group_messages, split_sentences, to_traditional
 
 load_dotenv('.env')
+
+# LOG_MODE=queue formats and writes logs on a background thread, the log file is
+# rotated at LOG_MAX_BYTES and arguments longer than LOG_MAX_LENGTH are cut.
+configure_logger(
+    queued=os.getenv('LOG_MODE', 'sync') == 'queue',
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+    backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+    max_length=int(os.getenv('LOG_MAX_LENGTH', '200')) or None)
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
 default_api_key = os.getenv('DEFAULT_API_KEY')
 
-memory = Memory(
-    system_message=os.getenv('SYSTEM_MESSAGE'),
-    memory_message_count=2)
-model_management = {}
-api_keys = {}
-
-dynamodb = boto3.resource(
-    'dynamodb',
-    aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-    region_name='us-west-1'
-)
-db_logger = DynamoDBLogHandler(dynamodb)
+# METRICS_ENABLED=false turns stage timing and counters off, /metrics then only has gauges.
+metrics.enabled = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+# Signature checks are timed whichever dispatch mode makes them.
+handler.parser.signature_validator.validate = metrics.timed('signature')(
+    handler.parser.signature_validator.validate)
+
+if 'mongo' in (os.getenv('MEMORY_BACKEND'), os.getenv('RATE_LIMIT_STORE'),
+               os.getenv('RESPONSE_CACHE'), os.getenv('API_KEY_STORE'),
+               os.getenv('WEBHOOK_DEDUP_STORE')):
+    mongodb.connect_to_database()
+
+openai_transport = HTTPTransport(
+    pool_size=int(os.getenv('OPENAI_POOL_SIZE', '10')),
+    connect_timeout=float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5')),
+    read_timeout=float(os.getenv('OPENAI_READ_TIMEOUT', '60')),
+    max_retries=int(os.getenv('OPENAI_MAX_RETRIES', '3')),
+    retry_budget=float(os.getenv('OPENAI_RETRY_BUDGET', '30')))
+# API_KEY_STORE=file|mongo answers users who registered an API key of their own
+# with it, the file store keeps the keys in API_KEY_FILE.
+storage = None
+if os.getenv('API_KEY_STORE') == 'file':
+    storage = Storage(FileStorage(os.getenv('API_KEY_FILE', 'db.json')))
+elif os.getenv('API_KEY_STORE') == 'mongo':
+    storage = Storage(MongoStorage(mongodb.db))
+model_management = ModelRegistry(
+    default_api_key=default_api_key,
+    transport=openai_transport,
+    key_resolver=storage.get if storage is not None else None,
+    max_models=int(os.getenv('OPENAI_MAX_MODELS', '1000')))
+
+# MEMORY_SUMMARY=true folds the older turns of a conversation into a summary written
+# by MEMORY_SUMMARY_ENGINE in the background, MEMORY_SUMMARY_KEEP_TURNS stay as they are.
+# Only the local memory backend summarizes.
+summarizer = None
+memory_summary = os.getenv('MEMORY_SUMMARY', 'false').lower() == 'true'
+if memory_summary and os.getenv('MEMORY_BACKEND', 'local') == 'mongo':
+    logger.warning('MEMORY_SUMMARY is ignored with MEMORY_BACKEND=mongo, conversations are not summarized.')
+elif memory_summary:
+    summarizer = Summarizer(
+        model_management.default_model,
+        os.getenv('MEMORY_SUMMARY_ENGINE') or os.getenv('OPENAI_MODEL_ENGINE'),
+        max_queue_size=int(os.getenv('MEMORY_SUMMARY_QUEUE_SIZE', '100')))
+
+# MEMORY_BACKEND=mongo shares conversations between worker processes.
+if os.getenv('MEMORY_BACKEND', 'local') == 'mongo':
+    memory = MongoMemory(
+        mongodb.db,
+        system_message=os.getenv('SYSTEM_MESSAGE'),
+        memory_message_count=int(os.getenv('MEMORY_MESSAGE_COUNT', '2')),
+        ttl=float(os.getenv('MEMORY_TTL', '86400')),
+        token_budgets=parse_token_budgets(os.getenv('MEMORY_TOKEN_BUDGETS')),
+        model_engine=os.getenv('OPENAI_MODEL_ENGINE'))
+else:
+    memory = Memory(
+        system_message=os.getenv('SYSTEM_MESSAGE'),
+        memory_message_count=int(os.getenv('MEMORY_MESSAGE_COUNT', '2')),
+        max_users=int(os.getenv('MEMORY_MAX_USERS', '10000')),
+        ttl=float(os.getenv('MEMORY_TTL', '86400')),
+        token_budgets=parse_token_budgets(os.getenv('MEMORY_TOKEN_BUDGETS')),
+        # MEMORY_SNAPSHOT_PATH keeps the conversations across restarts.
+        snapshot_path=os.getenv('MEMORY_SNAPSHOT_PATH'),
+        snapshot_interval=float(os.getenv('MEMORY_SNAPSHOT_INTERVAL', '60')),
+        summarizer=summarizer,
+        summary_keep_turns=int(os.getenv('MEMORY_SUMMARY_KEEP_TURNS', '2')))
+
+# RATE_LIMIT_USER_RATE / RATE_LIMIT_GLOBAL_RATE are completions per second,
+# RATE_LIMIT_STORE=mongo shares the buckets between processes.
+rate_limiter = RateLimiter(
+    store=MongoLimiterStore(mongodb.db) if os.getenv('RATE_LIMIT_STORE') == 'mongo'
+    else MemoryLimiterStore(),
+    user_rate=float(os.getenv('RATE_LIMIT_USER_RATE', '0')) or None,
+    user_burst=float(os.getenv('RATE_LIMIT_USER_BURST', '5')),
+    global_rate=float(os.getenv('RATE_LIMIT_GLOBAL_RATE', '0')) or None,
+    global_burst=float(os.getenv('RATE_LIMIT_GLOBAL_BURST', '20')))
+
+# RESPONSE_CACHE=local|mongo answers short first messages from earlier completions,
+# RESPONSE_CACHE_VARIANTS completions are collected per prompt before it is served.
+response_cache = None
+if os.getenv('RESPONSE_CACHE', 'off') in ('local', 'mongo'):
+    response_cache_ttl = float(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+    response_cache = ResponseCache(
+        store=MongoResponseStore(mongodb.db, ttl=response_cache_ttl)
+        if os.getenv('RESPONSE_CACHE') == 'mongo' else MemoryResponseStore(
+            max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '10000')),
+            ttl=response_cache_ttl,
+            max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_BYTES', '0')) or None),
+        max_prompt_length=int(os.getenv('RESPONSE_CACHE_MAX_PROMPT_LENGTH', '20')),
+        variants=int(os.getenv('RESPONSE_CACHE_VARIANTS', '3')))
+
+# OPENAI_STREAM=true replies with the first sentence as soon as it is generated
+# and pushes the rest in chunks of about STREAM_CHUNK_SIZE characters.
+stream_replies = os.getenv('OPENAI_STREAM', 'false').lower() == 'true'
+stream_chunk_size = int(os.getenv('STREAM_CHUNK_SIZE', '300'))
+
+
+def create_dynamodb_resource():
+    """
+    A DynamoDB resource, boto3 sessions and resources must not be shared between threads.
+    """
+    # Importing boto3 takes a while, it is left to the first log written or read.
+    # pylint: disable=import-outside-toplevel
+    import boto3
+
+    return boto3.session.Session(
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        region_name='us-west-1'
+    ).resource('dynamodb')
+
+
+# DYNAMODB_LOG_MODE=buffered writes logs behind in batches instead of on the request path.
+db_logger = DynamoDBLogHandler(
+    create_dynamodb_resource,
+    buffered=os.getenv('DYNAMODB_LOG_MODE', 'sync') == 'buffered',
+    flush_interval=float(os.getenv('DYNAMODB_LOG_FLUSH_INTERVAL', '1')),
+    # DYNAMODB_LOG_QUERY=auto reads logs from the indexes once `python -m src.migrate`
+    # created them, index or scan forces one way.
+    indexed={'index': True, 'scan': False}.get(os.getenv('DYNAMODB_LOG_QUERY', 'auto')),
+    query_cache_ttl=float(os.getenv('DYNAMODB_LOG_CACHE_TTL', '5')))
+
+# LINE redelivers events it got no answer for in time, WEBHOOK_DEDUP_STORE=mongo shares
+# the ids of handled events between processes and WEBHOOK_DEDUP_STORE=off handles every delivery.
+deduplicator = None
+if os.getenv('WEBHOOK_DEDUP_STORE', 'local') != 'off':
+    deduplicator = EventDeduplicator(
+        MongoSeenStore(mongodb.db) if os.getenv('WEBHOOK_DEDUP_STORE') == 'mongo'
+        else MemorySeenStore(max_keys=int(os.getenv('WEBHOOK_DEDUP_MAX_EVENTS', '100000'))),
+        ttl=float(os.getenv('WEBHOOK_DEDUP_TTL', '3600')))
+once = deduplicator.once if deduplicator is not None else (lambda func: func)
+
+# WEBHOOK_DISPATCH_MODE=async answers LINE right away and handles events on workers.
+dispatcher = None
+if os.getenv('WEBHOOK_DISPATCH_MODE', 'sync') == 'async':
+    dispatcher = EventDispatcher(
+        workers=int(os.getenv('WEBHOOK_WORKERS', '4')),
+        max_queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', '100')),
+        put_timeout=float(os.getenv('WEBHOOK_QUEUE_TIMEOUT', '0')))
+    dispatcher.start()
+
+draining = threading.Event()
+
+
+def warm_up():
+    """
+    Do the slow first-use work ahead of the first message: load the OpenCC
+    dictionaries and import boto3. gunicorn.conf.py runs it in the background.
+    """
+    get_s2t_converter()
+    create_dynamodb_resource()
+
+
+def shutdown(timeout: float = None):
+    """
+    Stop taking webhooks, answer the events already queued, flush the
+    buffered logs and snapshot the conversations. Called by the server when
+    a worker exits, see gunicorn.conf.py. `timeout` bounds the whole shutdown,
+    every step only gets the time the previous ones left.
+    """
+    draining.set()
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        return None if deadline is None else max(0, deadline - time.monotonic())
+
+    if dispatcher is not None:
+        dispatcher.shutdown(remaining())
+    db_logger.close(remaining())
+    memory.close()
 
 
 @app.route("/callback", methods=['POST'])
@@ -54,73 +229,188 @@ def callback():
     """
     The entrypoint of Line messages.
     """
+    if draining.is_set():
+        # LINE redelivers to a worker that is not shutting down.
+        abort(503)
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
-    logger.info("Request body: %s", body)
+    # The body holds every message of the batch, only worth its cost when debugging.
+    logger.debug("Request body: %s", body)
     try:
-        handler.handle(body, signature)
+        if dispatcher is None:
+            handler.handle(body, signature)
+        else:
+            # Verified and parsed once here, the workers only dispatch the events.
+            payload = handler.parser.parse(body, signature, as_payload=True)
+            if not dispatcher.submit(handler.dispatch, payload):
+                # Queue is full, let LINE redeliver later instead of piling up.
+                abort(503)
     except InvalidSignatureError:
-        print("Invalid signature. Please check your channel access token/channel secret.")
+        metrics.count('errors_total', error='invalid_signature')
+        logger.warning("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
     return 'OK'
 
 
 @handler.add(MessageEvent, message=TextMessage)
+@once
 def handle_text_message(event):
     """
     Currently we only received text message,
     so please put all logic in this part.
     """
     user_id = event.source.user_id
-    if not model_management.get(user_id):
-        model_management[user_id] = OpenAIModel(api_key=default_api_key)
-
     text = event.message.text.strip()
     logger.info('%s: %s', user_id, text)
 
+    if text.startswith('/系統訊息'):
+        memory.change_system_message(user_id, text[5:].strip())
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text='輸入成功'))
+        return
+
+    # Messages sent while the user's previous turn is running are answered together.
+    turn_coalescer.submit(user_id, event)
+
+
+def answer(user_id, events):
+    """
+    Answer one or more consecutive messages of a user with a single completion,
+    replying on the latest message's reply token.
+    """
+    event = events[-1]
+    text = '\n'.join(queued.message.text.strip() for queued in events)
+    model = model_management.get(user_id)
+
+    replied = False
+
+    def send(message):
+        # The reply token works once, anything after it is pushed.
+        nonlocal replied
+        if not replied:
+            replied = True
+            try:
+                with metrics.stage('reply'):
+                    line_bot_api.reply_message(event.reply_token, message)
+                return
+            except LineBotApiError as error:
+                # The token of a message that waited for a turn may have expired.
+                logger.warning('Reply failed, pushing instead: %s', error)
+        with metrics.stage('reply'):
+            line_bot_api.push_message(user_id, message)
+
+    engine = os.getenv('OPENAI_MODEL_ENGINE')
     try:
-        if text.startswith('/系統訊息'):
-            memory.change_system_message(user_id, text[5:].strip())
-            msg = TextSendMessage(text='輸入成功')
+        if not rate_limiter.allow(user_id):
+            metrics.count('errors_total', error='rate_limited')
+            msg = TextSendMessage(text='已超過負荷，請稍後再試')
 
         else:
-            memory.append(user_id, 'user', text)
-            is_successful, response, error_message = \
-                model_management[user_id].chat_completions(
-                    memory.get(user_id), os.getenv('OPENAI_MODEL_ENGINE'))
-
-            # pylint: disable=broad-exception-raised
-            if not is_successful:
-                raise BaseException(error_message)
-
-            role, response = get_role_and_content(response)
-            msg = TextSendMessage(text=response)
-            memory.append(user_id, role, response)
-            db_logger.write_log(
-                timestamp=int(time.time()),
-                user_id=user_id,
-                prompt=os.getenv('SYSTEM_MESSAGE'),
-                input_text=text,
-                output_text=response)
+            with metrics.stage('memory'):
+                memory.append(user_id, 'user', text)
+                messages = memory.get(user_id, engine)
+            cache_key = response_cache.key(engine, messages) if response_cache else None
+            cached = response_cache.get(cache_key) if cache_key else None
+            started_at = time.monotonic()
+
+            if cached is not None:
+                response = cached
+                msg = TextSendMessage(text=response)
+
+            elif stream_replies:
+                with metrics.stage('openai'):
+                    is_successful, deltas, error_message = \
+                        model.chat_completions_stream(messages, engine)
+
+                # pylint: disable=broad-exception-raised
+                if not is_successful:
+                    raise Exception(error_message)
+
+                parts = []
+                for part in group_messages(split_sentences(deltas), chunk_size=stream_chunk_size):
+                    parts.append(part)
+                    if part.strip():
+                        send(TextSendMessage(text=to_traditional(part.strip())))
+                msg = None
+                response = to_traditional(''.join(parts).strip())
+
+            else:
+                with metrics.stage('openai'):
+                    is_successful, response, error_message = \
+                        model.chat_completions(messages, engine)
+
+                # pylint: disable=broad-exception-raised
+                if not is_successful:
+                    raise Exception(error_message)
+
+                _, response = get_role_and_content(response)
+                msg = TextSendMessage(text=response)
+
+            if not response:
+                # Nothing was sent yet, the user gets the error reply instead of silence.
+                # pylint: disable=broad-exception-raised
+                raise Exception('OpenAI API 回傳了空白的回覆')
+
+            if cache_key and cached is None:
+                response_cache.put(cache_key, response, time.monotonic() - started_at)
+            with metrics.stage('memory'):
+                memory.append(user_id, 'assistant', response)
+            with metrics.stage('dynamodb'):
+                db_logger.write_log(
+                    timestamp=int(time.time()),
+                    user_id=user_id,
+                    prompt=os.getenv('SYSTEM_MESSAGE'),
+                    input_text=text,
+                    output_text=response)
 
     # pylint: disable=broad-exception-caught
     except Exception as error:
         logger.error(str(error))
 
         if str(error).startswith('Incorrect API key provided'):
+            metrics.count('errors_total', error='invalid_api_key')
             msg = TextSendMessage(text='OpenAI API Token 有誤，請重新註冊。')
 
         elif str(error).startswith('That model is currently overloaded with other requests.'):
+            metrics.count('errors_total', error='overloaded')
             msg = TextSendMessage(text='已超過負荷，請稍後再試')
 
         else:
+            metrics.count('errors_total', error='other')
             msg = TextSendMessage(
                 text='系統遇到一些錯誤，請截圖提供以下訊息給管理員。\n' + str(error))
 
-    line_bot_api.reply_message(event.reply_token, msg)
+    if msg is not None:
+        send(msg)
+
+
+# MESSAGE_DEBOUNCE_WINDOW waits for the user to stop typing before answering.
+turn_coalescer = TurnCoalescer(
+    answer,
+    window=float(os.getenv('MESSAGE_DEBOUNCE_WINDOW', '0')),
+    max_wait=float(os.getenv('MESSAGE_DEBOUNCE_MAX_WAIT', '0')) or None)
+
+metrics.gauge('active_users', memory.count,
+              'Users with a conversation in memory.')
+metrics.gauge('answering_users', lambda: turn_coalescer.stats()['active_users'],
+              'Users whose turn is being answered.')
+metrics.gauge('openai_in_flight', lambda: sum(
+    model_management.stats()[kind]['in_flight'] for kind in ('default', 'custom')),
+              'OpenAI requests in flight.')
+metrics.gauge('openai_pool_size', lambda: openai_transport.pool_size,
+              'Connections kept per OpenAI host.')
+metrics.gauge('openai_connections_idle', lambda: openai_transport.stats()['connections_idle'],
+              'Idle pooled OpenAI connections.')
+metrics.gauge('dynamodb_buffered', lambda: db_logger.stats()['buffered'],
+              'Logs waiting to be written to DynamoDB.')
+if dispatcher is not None:
+    metrics.gauge('webhook_queue_depth', dispatcher.qsize,
+                  'Webhook events waiting for a worker.')
+    metrics.gauge('webhook_busy_workers', lambda: dispatcher.stats()['busy_workers'],
+                  'Workers handling a webhook event.')
 
 
 @handler.add(MessageEvent, message=AudioMessage)
+@once
 def handle_audio_message(event):
     """
     No audio message.
@@ -131,6 +421,7 @@ def handle_audio_message(event):
 
 
 @handler.add(MessageEvent, message=ImageMessage)
+@once
 def handle_image_message(event):
     """
     No image message.
@@ -228,7 +519,37 @@ def home_page():
 @app.route("/logs", methods=['GET', 'POST'])
 @login_required
 def current_logs():
-    return render_template("logs.html", tbody=Markup(db_logger.get_log_html_body()))
+    return render_template("logs.html")
+
+
+@app.route("/api/logs", methods=['GET'])
+@login_required
+def api_logs():
+    """
+    One page of logs as JSON, newest first.
+    Pass the returned `next_cursor` back as `cursor` to get the next page,
+    a malformed or tampered cursor gets 400.
+    """
+    try:
+        rows, next_cursor = db_logger.query_log_page(
+            from_timestamp=request.args.get('from', type=int),
+            to_timestamp=request.args.get('to', type=int),
+            user_id=request.args.get('user_id') or None,
+            limit=max(1, min(request.args.get('limit', 20, type=int), 100)),
+            cursor=request.args.get('cursor') or None)
+    except ValueError:
+        abort(400)
+    return jsonify({
+        'data': [{
+            'timestamp': int(row['timestamp']),
+            'time': format_timestamp(row['timestamp']),
+            'user_id': row.get('user_id'),
+            'prompt': row.get('prompt'),
+            'input_text': row.get('input_text'),
+            'output_text': row.get('output_text'),
+        } for row in rows],
+        'next_cursor': next_cursor
+    })
 
 
 @app.route('/css/<path:path>')
@@ -251,5 +572,60 @@ def wakeup():
     return 'ok'
 
 
+@app.route('/ready')
+def ready():
+    if draining.is_set():
+        return 'draining', 503
+    if dispatcher is not None and dispatcher.max_queue_size and \
+            dispatcher.qsize() >= dispatcher.max_queue_size:
+        return 'busy', 503
+    return 'ok'
+
+
+@app.route('/stats/dispatcher')
+@login_required
+def dispatcher_stats():
+    if dispatcher is None:
+        return jsonify({'mode': 'sync'})
+    return jsonify({'mode': 'async', **dispatcher.stats()})
+
+
+@app.route('/stats/webhook')
+@login_required
+def webhook_stats():
+    if deduplicator is None:
+        return jsonify({'deduplication': 'off'})
+    return jsonify(deduplicator.stats())
+
+
+@app.route('/stats/memory')
+@login_required
+def memory_stats():
+    return jsonify(memory.stats())
+
+
+@app.route('/stats/dynamodb')
+@login_required
+def dynamodb_stats():
+    return jsonify(db_logger.stats())
+
+
+@app.route('/stats/openai')
+@login_required
+def openai_stats():
+    return jsonify({
+        **openai_transport.stats(),
+        'registry': model_management.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'coalescer': turn_coalescer.stats(),
+        'response_cache': response_cache.stats() if response_cache else None
+    })
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8080)
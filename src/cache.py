@@ -0,0 +1,140 @@
+"""
+cache.py
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+
+class TTLCache:
+    """
+    A thread-safe mapping that evicts the least recently used entry once
+    `max_size` entries (or `max_bytes` of entries) are stored and forgets
+    entries older than `ttl` seconds.
+    """
+
+    def __init__(self, max_size: int = 128, ttl: float = None, max_bytes: int = None):
+        """
+        Initialize the TTLCache instance.
+
+        Params:
+            max_size: int. Max number of entries.
+            ttl: float. Seconds an entry stays valid, None keeps it until evicted.
+            max_bytes: int. Max total of the sizes given to `set`, None for no limit.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        The value stored for `key`, `default` if missing or expired.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._counters['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None, size: int = 0):
+        """
+        Store a value, `ttl` overrides the default time to live of the cache
+        and `size` is what the value counts against `max_bytes`.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expire_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (expire_at, value, size)
+            self.total_bytes += size
+            while len(self._data) > self.max_size or \
+                    (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                self._remove(next(iter(self._data)))
+                self._counters['evictions'] += 1
+
+    def _remove(self, key: Hashable):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+        return entry
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove `key` and return its value.
+        """
+        with self._lock:
+            entry = self._remove(key)
+        return default if entry is None else entry[1]
+
+    def discard_if(self, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        Remove every entry whose key matches `predicate`.
+
+        Returns:
+            int. Number of entries removed.
+        """
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def update_each(self, update: Callable[[Hashable, Any], Any]) -> int:
+        """
+        Replace the value of every entry with `update(key, value)`, keeping
+        its expiry and size. Entries it returns None for are removed.
+
+        Returns:
+            int. Number of entries removed.
+        """
+        removed = 0
+        with self._lock:
+            for key, (expire_at, value, size) in list(self._data.items()):
+                value = update(key, value)
+                if value is None:
+                    self._remove(key)
+                    removed += 1
+                else:
+                    self._data[key] = (expire_at, value, size)
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        with self._lock:
+            self._data.clear()
+            self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict:
+        """
+        Size and hit/miss counters.
+        """
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'bytes': self.total_bytes,
+                'hit_ratio': self._counters['hits'] / lookups if lookups else 0.0,
+                **self._counters
+            }
@@ -0,0 +1,97 @@
+"""
+coalesce.py
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class TurnCoalescer:
+    """
+    Runs at most one turn per user at a time.
+
+    Messages a user sends while their turn is running are queued and
+    answered together by a single follow-up turn, so a burst of messages
+    costs one completion instead of one each.
+
+    With a debounce `window` a turn also waits until the user has been
+    quiet for `window` seconds, at most `max_wait` seconds, before it
+    starts, so messages typed in quick succession go out together.
+    """
+
+    def __init__(self, process: Callable[[str, List[Any]], None],
+                 window: float = 0, max_wait: float = None):
+        """
+        Initialize the TurnCoalescer instance.
+
+        Params:
+            process: Callable answering a user's queued items in one turn.
+            window: float. Seconds of silence a turn waits for, 0 starts right away.
+            max_wait: float. Upper bound of that wait, three windows by default.
+        """
+        self.process = process
+        self.window = window
+        self.max_wait = window * 3 if max_wait is None else max_wait
+        self._pending = {}
+        self._last_arrival = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            'turns': 0,
+            'coalesced': 0,
+        }
+
+    def submit(self, user_id: str, item: Any) -> bool:
+        """
+        Answer `item` now, or queue it if a turn of the user is running.
+
+        Returns:
+            bool. False if the item was queued for the running turn's thread.
+        """
+        with self._lock:
+            self._last_arrival[user_id] = time.monotonic()
+            if user_id in self._pending:
+                self._pending[user_id].append(item)
+                self._counters['coalesced'] += 1
+                return False
+            self._pending[user_id] = [item]
+
+        while True:
+            if self.window > 0:
+                self._wait_quiet(user_id)
+            with self._lock:
+                items = self._pending[user_id]
+                if not items:
+                    del self._pending[user_id]
+                    del self._last_arrival[user_id]
+                    return True
+                self._pending[user_id] = []
+                self._counters['turns'] += 1
+            try:
+                self.process(user_id, items)
+            # pylint: disable=broad-exception-caught
+            except Exception:
+                logger.exception('Failed to answer %s.', user_id)
+
+    def _wait_quiet(self, user_id: str):
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._lock:
+                quiet_at = self._last_arrival[user_id] + self.window
+            now = time.monotonic()
+            if now >= quiet_at or now >= deadline:
+                return
+            time.sleep(min(quiet_at, deadline) - now)
+
+    def stats(self) -> Dict:
+        """
+        Users with a running turn and turn counters.
+        """
+        with self._lock:
+            return {
+                'active_users': len(self._pending),
+                **self._counters
+            }
@@ -0,0 +1,154 @@
+"""
+dedup.py
+"""
+
+import datetime
+import functools
+import logging
+import threading
+from typing import Callable, Dict
+
+from src.cache import TTLCache
+from src.metrics import metrics
+from src.mongodb import create_ttl_index, expired_filter, insert_unique
+
+logger = logging.getLogger(__name__)
+
+
+class SeenStoreInterface:
+    """
+    Where the ids of handled webhook events are kept, so that several
+    processes can share them.
+    """
+
+    def add(self, key: str, ttl: float) -> bool:
+        """
+        Remember `key` for `ttl` seconds.
+
+        Returns:
+            bool. False if `key` was already remembered, nothing changes then.
+        """
+        raise NotImplementedError
+
+    def discard(self, key: str):
+        """
+        Forget `key`, so it can be added again.
+        """
+        raise NotImplementedError
+
+
+class MemorySeenStore(SeenStoreInterface):
+    """
+    Event ids kept in this process, the least recently added are evicted first.
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.keys = TTLCache(max_size=max_keys)
+        self._lock = threading.Lock()
+
+    def add(self, key: str, ttl: float) -> bool:
+        with self._lock:
+            if self.keys.get(key) is not None:
+                return False
+            self.keys.set(key, True, ttl=ttl)
+            return True
+
+    def discard(self, key: str):
+        self.keys.pop(key)
+
+
+class MongoSeenStore(SeenStoreInterface):
+    """
+    Event ids kept in MongoDB. The unique `_id` makes adding atomic across
+    processes, expired ids are removed by a TTL index.
+    """
+
+    def __init__(self, db, collection: str = 'webhook_events'):
+        self.collection = db[collection]
+        create_ttl_index(self.collection)
+
+    def add(self, key: str, ttl: float) -> bool:
+        now = datetime.datetime.utcnow()
+        new_expire_at = now + datetime.timedelta(seconds=ttl)
+        if insert_unique(self.collection, {'_id': key, 'expire_at': new_expire_at}):
+            return True
+        # An expired id is taken over.
+        return self.collection.find_one_and_update(
+            {'_id': key, **expired_filter(now)},
+            {'$set': {'expire_at': new_expire_at}}) is not None
+
+    def discard(self, key: str):
+        self.collection.delete_one({'_id': key})
+
+
+class EventDeduplicator:
+    """
+    Handles every webhook event once. LINE redelivers an event when it got
+    no answer in time, a redelivered event has the same `webhook_event_id`
+    and is acknowledged without being handled again.
+
+    An event is marked as seen when its handling starts, so a redelivery
+    arriving while it is still being handled is skipped too. If handling
+    raises, the mark is removed and the next redelivery is handled.
+    """
+
+    def __init__(self, store: SeenStoreInterface, ttl: float = 3600):
+        """
+        Initialize the EventDeduplicator instance.
+
+        Params:
+            store: SeenStoreInterface. Where the seen event ids are kept.
+            ttl: float. Seconds an event id is remembered, longer than LINE keeps redelivering.
+        """
+        self.store = store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counters = {
+            'handled': 0,
+            'suppressed': 0,
+            'store_errors': 0,
+        }
+
+    def first_seen(self, event_id: str) -> bool:
+        """
+        Returns:
+            bool. True unless `event_id` was seen within the last `ttl` seconds.
+        """
+        # pylint: disable=broad-exception-caught
+        try:
+            added = self.store.add(event_id, self.ttl)
+        except Exception:
+            # Handling an event twice is better than not at all.
+            logger.exception('Could not check webhook event %s.', event_id)
+            self._count('store_errors')
+            return True
+        self._count('handled' if added else 'suppressed')
+        return added
+
+    def once(self, func: Callable) -> Callable:
+        """
+        Decorate a `WebhookHandler` handler so each event reaches it once.
+        """
+        @functools.wraps(func)
+        def wrapper(event):
+            event_id = getattr(event, 'webhook_event_id', None)
+            if event_id is None:
+                return func(event)
+            if not self.first_seen(event_id):
+                metrics.count('webhook_duplicates_total')
+                logger.info('Skipped redelivered event %s', event_id)
+                return None
+            try:
+                return func(event)
+            except Exception:
+                self.store.discard(event_id)
+                raise
+        return wrapper
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._counters)
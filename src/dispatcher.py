@@ -0,0 +1,143 @@
+"""
+dispatcher.py
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class EventDispatcher:
+    """
+    Run jobs on a pool of worker threads fed by a bounded in-process queue.
+
+    The webhook only has to enqueue a job and can answer LINE right away,
+    the slow parts (OpenAI, DynamoDB, reply) happen on the workers.
+    """
+
+    def __init__(self, workers: int = 4, max_queue_size: int = 100, put_timeout: float = 0):
+        """
+        Initialize the EventDispatcher instance.
+
+        Params:
+            workers: int. Number of worker threads.
+            max_queue_size: int. Jobs allowed to wait in the queue.
+            put_timeout: float. Seconds `submit` waits for a free slot
+                before shedding the job, 0 sheds immediately.
+        """
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._counters = {
+            'submitted': 0,
+            'processed': 0,
+            'failed': 0,
+            'dropped': 0,
+        }
+
+    def start(self):
+        """
+        Start the worker threads, calling it twice is a no-op.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f'dispatcher-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, func: Callable, *args, **kwargs) -> bool:
+        """
+        Put a job on the queue.
+
+        Returns:
+            bool. False if the queue is full and the job was shed.
+        """
+        try:
+            if self.put_timeout > 0:
+                self.queue.put((func, args, kwargs), timeout=self.put_timeout)
+            else:
+                self.queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            self._count('dropped')
+            logger.warning('Dispatcher queue is full, dropped a job.')
+            return False
+        self._count('submitted')
+        return True
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            func, args, kwargs = job
+            with self._lock:
+                self._busy += 1
+            try:
+                func(*args, **kwargs)
+                self._count('processed')
+            # pylint: disable=broad-exception-caught
+            except Exception:
+                self._count('failed')
+                logger.exception('Dispatcher job failed.')
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                self.queue.task_done()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def qsize(self) -> int:
+        """
+        Jobs currently waiting in the queue.
+        """
+        return self.queue.qsize()
+
+    def stats(self) -> Dict:
+        """
+        Queue depth, worker usage and job counters.
+        """
+        with self._lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_queue_size': self.max_queue_size,
+                'workers': len(self._threads),
+                'busy_workers': self._busy,
+                **self._counters
+            }
+
+    def shutdown(self, timeout: float = None):
+        """
+        Let the workers finish the queued jobs, then stop them.
+
+        Params:
+            timeout: float. Seconds to wait for all the workers together.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(0, deadline - time.monotonic())
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+        try:
+            for _ in threads:
+                self.queue.put(None, timeout=remaining())
+        except queue.Full:
+            logger.warning('Dispatcher queue is still full, stopped waiting for the workers.')
+            return
+        for thread in threads:
+            thread.join(remaining())
@@ -1,6 +1,13 @@
+import atexit
+import json
 import os
 import logging
 import logging.handlers
+import queue
+
+# Modules under src/ log through `logging.getLogger(__name__)`, their records
+# reach the handlers through the `src` logger.
+LOGGER_NAMES = ('chatgpt_logger', 'src')
 
 
 class CustomFormatter(logging.Formatter):
@@ -38,28 +45,124 @@ class CustomFormatter(logging.Formatter):
         return output
 
 
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line and no color codes, for log files.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TruncateFilter(logging.Filter):
+    """
+    Cut string arguments longer than `max_length` characters, so a large
+    payload costs the same to log as a small one.
+    """
+
+    def __init__(self, max_length):
+        super().__init__()
+        self.max_length = max_length
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_length:
+            return f'{value[:self.max_length]}...({len(value)} chars)'
+        return value
+
+    def filter(self, record):
+        # Every handler filters the same record, it is only cut once.
+        if isinstance(record.args, tuple) and not getattr(record, 'truncated', False):
+            record.args = tuple(self._truncate(arg) for arg in record.args)
+            record.truncated = True
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a `QueueListener` as they are, formatting happens on
+    the listener's thread. Records are dropped while the queue is full.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            QueueHandler.dropped += 1
+
+
 class LoggerFactory:
     @staticmethod
-    def create_logger(formatter, handlers):
-        logger = logging.getLogger('chatgpt_logger')
-        logger.setLevel(logging.INFO)
+    def create_logger(formatter, handlers, queued=False, max_queue_size=10000, filters=()):
         for handler in handlers:
             handler.setLevel(logging.DEBUG)
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
-        return logger
+            if handler.formatter is None:
+                handler.setFormatter(formatter)
+        if queued:
+            listener = logging.handlers.QueueListener(
+                queue.Queue(max_queue_size), *handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            handlers = [QueueHandler(listener.queue)]
+        # Filters go on the handlers, a logger's own filters skip records of its children.
+        for handler in handlers:
+            for handler_filter in filters:
+                handler.addFilter(handler_filter)
+        for name in LOGGER_NAMES:
+            named_logger = logging.getLogger(name)
+            named_logger.setLevel(logging.INFO)
+            for handler in handlers:
+                named_logger.addHandler(handler)
+        return logging.getLogger(LOGGER_NAMES[0])
 
 
-class FileHandler(logging.FileHandler):
-    def __init__(self, log_file):
+class FileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, log_file, max_bytes=0, backup_count=0):
         os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        super().__init__(log_file)
+        # The file is opened by the first record, not on import.
+        super().__init__(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8', delay=True)
+        self.setFormatter(JSONFormatter())
 
 
 class ConsoleHandler(logging.StreamHandler):
     pass
 
 
+def configure_logger(queued=False, max_bytes=0, backup_count=0, max_length=None):
+    """
+    Replace the handlers of `logger` and of the `src` module loggers.
+
+    Params:
+        queued: bool. Format and write records on a background thread.
+        max_bytes: int. Size at which the log file is rotated, 0 never rotates.
+        backup_count: int. Rotated log files kept.
+        max_length: int. Longest string argument logged in full, None for no limit.
+    """
+    for name in LOGGER_NAMES:
+        named_logger = logging.getLogger(name)
+        for handler in list(named_logger.handlers):
+            named_logger.removeHandler(handler)
+            handler.close()
+    LoggerFactory.create_logger(
+        formatter,
+        [FileHandler('./logs', max_bytes, backup_count), ConsoleHandler()],
+        queued=queued,
+        filters=[TruncateFilter(max_length)] if max_length else ())
+
+
 formatter = CustomFormatter()
 file_handler = FileHandler('./logs')
 console_handler = ConsoleHandler()
@@ -2,7 +2,22 @@
 """
 DocString.
 """
-from collections import defaultdict
+import atexit
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List
+
+from src.mongodb import \
+    create_ttl_index, expire_at, expired_expression, find_one_and_update_after, is_expired
+from src.snapshot import SnapshotReader, encode_record, write_snapshot
+from src.tokens import MESSAGE_OVERHEAD, count_tokens
+
+logger = logging.getLogger(__name__)
 
 
 class MemoryInterface:
@@ -15,42 +30,512 @@ class MemoryInterface:
     def remove(self, user_id: str) -> None:
         raise NotImplementedError
 
+    def close(self) -> None:
+        pass
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+
+class _Turn:
+    __slots__ = ('role', 'content', 'tokens')
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+        # Counted on first use and kept, the content never changes.
+        self.tokens = None
+
+
+class _Conversation:
+    __slots__ = ('system_message', 'system_tokens', 'turns', 'last_access',
+                 'summary', 'summary_tokens', 'version', 'summarizing')
+
+    def __init__(self, system_message: str, max_turns: int):
+        self.system_message = system_message
+        self.system_tokens = None
+        self.turns = deque(maxlen=max_turns)
+        self.last_access = time.monotonic()
+        # Summary of the turns before `turns`, see `Memory.summarizer`.
+        self.summary = None
+        self.summary_tokens = None
+        # Bumped whenever the history is replaced, a summary of an older version is stale.
+        self.version = 0
+        self.summarizing = False
+
+    def reset(self):
+        self.turns.clear()
+        self.summary = None
+        self.summary_tokens = None
+        self.version += 1
+        self.summarizing = False
+
+
+SUMMARY_PREFIX = '先前對話的摘要：\n'
+
+
+def _token_budget(token_budgets: Dict[str, int], model_engine: str) -> int:
+    if model_engine is None:
+        return None
+    return token_budgets.get(model_engine, token_budgets.get('*'))
+
+
+def _fit(conversation: _Conversation, system_message: str,
+         budget: int, model_engine: str) -> List[_Turn]:
+    # The largest suffix of turns that fits next to the system message,
+    # the latest turn is always kept so there is something to answer.
+    if conversation.system_tokens is None:
+        conversation.system_tokens = MESSAGE_OVERHEAD + count_tokens(system_message, model_engine)
+    remaining = budget - conversation.system_tokens
+    if conversation.summary:
+        if conversation.summary_tokens is None:
+            conversation.summary_tokens = MESSAGE_OVERHEAD + \
+                count_tokens(SUMMARY_PREFIX + conversation.summary, model_engine)
+        remaining -= conversation.summary_tokens
+    turns = []
+    for turn in reversed(conversation.turns):
+        if turn.tokens is None:
+            turn.tokens = MESSAGE_OVERHEAD + count_tokens(turn.content, model_engine)
+        remaining -= turn.tokens
+        if remaining < 0 and turns:
+            break
+        turns.append(turn)
+    turns.reverse()
+    return turns
+
+
+def _to_messages(conversation: _Conversation, default_system_message: str,
+                 budget: int, model_engine: str) -> List[Dict]:
+    system_message = conversation.system_message or default_system_message
+    turns = conversation.turns if budget is None else \
+        _fit(conversation, system_message, budget, model_engine)
+    messages = [{'role': 'system', 'content': system_message}]
+    if conversation.summary:
+        messages.append({'role': 'system', 'content': SUMMARY_PREFIX + conversation.summary})
+    return messages + [{'role': turn.role, 'content': turn.content} for turn in turns]
+
 
 class Memory(MemoryInterface):
-    def __init__(self, system_message: str, memory_message_count: int):
-        self.storage = defaultdict(list)
-        self.system_messages = defaultdict(str)
+    """
+    Keeps the latest `memory_message_count` pairs of every user,
+    plus the message being answered.
+
+    At most `max_users` conversations are kept, the least recently used
+    one is evicted first, and conversations idle for more than `ttl`
+    seconds are dropped.
+
+    `token_budgets` maps model engines (or `*` for any engine) to the
+    prompt size `get` may return when it is given that engine.
+
+    With a `snapshot_path`, the conversations are written there every
+    `snapshot_interval` seconds and on `close`, from a background thread.
+    Only a shallow copy of the conversations is taken under the lock, the
+    turns themselves never change, so encoding does not block requests.
+    A snapshot found on start is mapped, not loaded: a user's conversation
+    is restored when the user is first looked up, unless it expired since,
+    and users nobody asked about yet are carried over to the next snapshot.
+
+    With a `summarizer`, once a conversation fills its window the turns
+    before the latest `summary_keep_turns` are folded into a summary on
+    the summarizer's thread. The summary is sent next to the system message
+    and the summarized turns are dropped. A summary is only applied to the
+    version of the conversation it was made from, so a conversation reset
+    meanwhile is left alone, and turns appended meanwhile are kept.
+    """
+
+    def __init__(self, system_message: str, memory_message_count: int,
+                 max_users: int = None, ttl: float = None,
+                 token_budgets: Dict[str, int] = None,
+                 snapshot_path: str = None, snapshot_interval: float = 60,
+                 summarizer=None, summary_keep_turns: int = 2):
+        self.conversations = OrderedDict()
+        self.default_system_message = system_message
+        self.memory_message_count = memory_message_count
+        self.max_users = max_users
+        self.ttl = ttl
+        self.token_budgets = token_budgets or {}
+        self._lock = threading.RLock()
+
+        self.summarizer = summarizer
+        self.summary_keep_turns = summary_keep_turns
+        self._counters = {
+            'summaries': 0,
+            'stale_summaries': 0,
+            'tokens_saved': 0,
+        }
+
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._snapshot = None
+        self._changes = 0
+        self._snapshot_changes = 0
+        self._snapshot_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._snapshot_writer = None
+        if snapshot_path:
+            if os.path.exists(snapshot_path):
+                try:
+                    self._snapshot = SnapshotReader(snapshot_path)
+                except (OSError, ValueError) as error:
+                    logger.warning('Ignoring memory snapshot: %s', error)
+            if snapshot_interval:
+                self._snapshot_writer = threading.Thread(
+                    target=self._write_snapshots, name='memory-snapshot', daemon=True)
+                self._snapshot_writer.start()
+            atexit.register(self.close)
+
+    def _max_turns(self) -> int:
+        return self.memory_message_count * 2 + 1
+
+    def _expired(self, conversation: _Conversation, now: float) -> bool:
+        return self.ttl is not None and now - conversation.last_access > self.ttl
+
+    def _evict(self, now: float):
+        # Conversations are ordered by last access, expired ones are at the front.
+        while self.conversations:
+            user_id, conversation = next(iter(self.conversations.items()))
+            over_capacity = self.max_users is not None and len(self.conversations) > self.max_users
+            if not over_capacity and not self._expired(conversation, now):
+                break
+            del self.conversations[user_id]
+
+    def _snapshot_reader(self) -> SnapshotReader:
+        """
+        The snapshot, None if there is none or it turned out to be corrupt.
+        A corrupt snapshot is dropped and replaced by the next one written.
+        """
+        if self._snapshot is not None:
+            try:
+                self._snapshot.validate()
+            except ValueError as error:
+                logger.warning('Dropping the memory snapshot: %s', error)
+                self._snapshot.close()
+                self._snapshot = None
+        return self._snapshot
+
+    def _restore(self, user_id: str, now: float) -> _Conversation:
+        try:
+            taken = self._snapshot.take(user_id)
+        except ValueError as error:
+            logger.warning('Skipping a memory snapshot record: %s', error)
+            return None
+        if taken is None:
+            return None
+        last_access, system_message, turns, summary = taken
+        conversation = _Conversation(system_message, self._max_turns())
+        conversation.summary = summary
+        for role, content, tokens in turns:
+            turn = _Turn(role, content)
+            turn.tokens = tokens
+            conversation.turns.append(turn)
+        conversation.last_access = now - (time.time() - last_access)
+        self.conversations[user_id] = conversation
+        return conversation
+
+    def _lookup(self, user_id: str, create: bool = False) -> _Conversation:
+        now = time.monotonic()
+        conversation = self.conversations.get(user_id)
+        if conversation is None and self._snapshot_reader() is not None:
+            conversation = self._restore(user_id, now)
+        if conversation is not None and self._expired(conversation, now):
+            del self.conversations[user_id]
+            conversation = None
+        if conversation is None:
+            if not create:
+                return None
+            conversation = _Conversation(None, self._max_turns())
+            self.conversations[user_id] = conversation
+        else:
+            self.conversations.move_to_end(user_id)
+        conversation.last_access = now
+        self._evict(now)
+        return conversation
+
+    def change_system_message(self, user_id, system_message):
+        with self._lock:
+            self._changes += 1
+            conversation = self._lookup(user_id, create=True)
+            conversation.system_message = system_message
+            conversation.system_tokens = None
+            conversation.reset()
+
+    def append(self, user_id: str, role: str, content: str) -> None:
+        with self._lock:
+            self._changes += 1
+            conversation = self._lookup(user_id, create=True)
+            conversation.turns.append(_Turn(role, content))
+            if self.summarizer is not None and not conversation.summarizing and \
+                    len(conversation.turns) >= self._max_turns():
+                self._summarize(conversation)
+
+    def _summarize(self, conversation: _Conversation):
+        turns = tuple(conversation.turns)[:-self.summary_keep_turns or None]
+        if not turns:
+            return
+        version = conversation.version
+        # Dropped on a full queue, the next append tries again.
+        conversation.summarizing = self.summarizer.submit(
+            conversation.summary,
+            [{'role': turn.role, 'content': turn.content} for turn in turns],
+            lambda summary: self._apply_summary(conversation, version, turns, summary))
+
+    def _apply_summary(self, conversation: _Conversation, version: int,
+                       turns: tuple, summary: str):
+        engine = self.summarizer.model_engine
+        summarized_tokens = sum(MESSAGE_OVERHEAD + count_tokens(turn.content, engine) for turn in turns)
+        with self._lock:
+            if conversation.version != version:
+                self._counters['stale_summaries'] += 1
+                return
+            conversation.summarizing = False
+            if summary is None:
+                return
+            saved = summarized_tokens - MESSAGE_OVERHEAD - count_tokens(SUMMARY_PREFIX + summary, engine)
+            if conversation.summary:
+                saved += MESSAGE_OVERHEAD + count_tokens(SUMMARY_PREFIX + conversation.summary, engine)
+            # The summarized turns are still the oldest ones, unless the window already dropped them.
+            summarized = {id(turn) for turn in turns}
+            while conversation.turns and id(conversation.turns[0]) in summarized:
+                conversation.turns.popleft()
+            conversation.summary = summary
+            conversation.summary_tokens = None
+            conversation.version += 1
+            self._changes += 1
+            self._counters['summaries'] += 1
+            self._counters['tokens_saved'] += saved
+
+    def get(self, user_id: str, model_engine: str = None) -> List[Dict]:
+        with self._lock:
+            conversation = self._lookup(user_id)
+            if conversation is None or not conversation.turns:
+                return []
+            return _to_messages(
+                conversation, self.default_system_message,
+                _token_budget(self.token_budgets, model_engine), model_engine)
+
+    def remove(self, user_id: str) -> None:
+        with self._lock:
+            self._changes += 1
+            conversation = self.conversations.get(user_id)
+            if conversation is not None:
+                conversation.reset()
+            elif self._snapshot_reader() is not None:
+                self._snapshot.discard(user_id)
+
+    def snapshot(self) -> bool:
+        """
+        Write the conversations to `snapshot_path`.
+
+        Returns:
+            bool. False if nothing changed since the last snapshot.
+        """
+        with self._snapshot_lock:
+            with self._lock:
+                if self._changes == self._snapshot_changes:
+                    return False
+                changes = self._changes
+                now, wall_now = time.monotonic(), time.time()
+                self._evict(now)
+                captured = [
+                    (user_id, wall_now - (now - conversation.last_access),
+                     conversation.system_message, tuple(conversation.turns), conversation.summary)
+                    for user_id, conversation in self.conversations.items()
+                    if conversation.turns or conversation.system_message]
+                pending = []
+                if self._snapshot_reader() is not None:
+                    pending = self._snapshot.pending(
+                        None if self.ttl is None else wall_now - self.ttl)
+
+            records = [
+                encode_record(user_id, last_access, system_message,
+                              ((turn.role, turn.content, turn.tokens) for turn in turns), summary)
+                for user_id, last_access, system_message, turns, summary in captured]
+            if pending:
+                # Least recently used first, as restored users are evicted first too.
+                records = [self._snapshot.read(span) for span in pending] + records
+            if self.max_users is not None:
+                records = records[-self.max_users:]
+            write_snapshot(self.snapshot_path, records)
+            self._snapshot_changes = changes
+            return True
+
+    def _write_snapshots(self):
+        while not self._stop.wait(self.snapshot_interval):
+            # pylint: disable=broad-exception-caught
+            try:
+                self.snapshot()
+            except Exception:
+                logger.exception('Failed to write the memory snapshot.')
+
+    def close(self) -> None:
+        if not self.snapshot_path or self._stop.is_set():
+            return
+        self._stop.set()
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.join()
+        self.snapshot()
+
+    def count(self) -> int:
+        """
+        Number of users kept, cheap enough for every metrics scrape.
+        """
+        with self._lock:
+            self._evict(time.monotonic())
+            return len(self.conversations)
+
+    def stats(self) -> Dict:
+        """
+        Number of users and turns kept, with their approximate size in bytes.
+        Walks every turn while holding the lock, see `count` for a cheap count.
+        """
+        with self._lock:
+            self._evict(time.monotonic())
+            turns, size = 0, sys.getsizeof(self.conversations)
+            for user_id, conversation in self.conversations.items():
+                size += sys.getsizeof(user_id) + sys.getsizeof(conversation) + \
+                    sys.getsizeof(conversation.turns)
+                if conversation.system_message:
+                    size += sys.getsizeof(conversation.system_message)
+                for turn in conversation.turns:
+                    size += sys.getsizeof(turn) + sys.getsizeof(turn.content)
+                turns += len(conversation.turns)
+            return {
+                'users': len(self.conversations),
+                'max_users': self.max_users,
+                'turns': turns,
+                'approx_bytes': size,
+                'snapshot_pending': 0 if self._snapshot is None else len(self._snapshot),
+                **self._counters,
+                'summarizer': None if self.summarizer is None else self.summarizer.stats()
+            }
+
+
+class MongoMemory(MemoryInterface):
+    """
+    Keeps conversations in a MongoDB collection so that every worker
+    process sees the same history.
+
+    Appending pushes and trims the window in a single `find_one_and_update`,
+    documents expire `ttl` seconds after the last append through a TTL
+    index, and documents read or written lately are served from a small
+    local cache for `cache_ttl` seconds. A document past its expiry that
+    the TTL monitor has not removed yet is started over on the next append.
+    """
+
+    def __init__(self, db, system_message: str, memory_message_count: int,
+                 ttl: float = None, token_budgets: Dict[str, int] = None,
+                 model_engine: str = None, cache_size: int = 1000,
+                 cache_ttl: float = 2, collection: str = 'memory'):
+        self.collection = db[collection]
         self.default_system_message = system_message
         self.memory_message_count = memory_message_count
+        self.ttl = ttl
+        self.token_budgets = token_budgets or {}
+        self.model_engine = model_engine
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {'cache_hits': 0, 'cache_misses': 0}
 
-    def _initialize(self, user_id: str):
-        self.storage[user_id] = [{
-            'role': 'system',
-            'content': self.default_system_message
-        }]
+        self.collection.create_index('user_id', unique=True)
+        if ttl is not None:
+            create_ttl_index(self.collection)
 
-    def _drop_message(self, user_id: str):
-        if len(self.storage.get(user_id)) >= (self.memory_message_count + 1) * 2 + 1:
-            return [
-                self.storage[user_id][0]] + \
-                self.storage[user_id][-(self.memory_message_count * 2):]
-        return self.storage.get(user_id)
+    def _max_turns(self) -> int:
+        return self.memory_message_count * 2 + 1
+
+    def _expire_at(self) -> dict:
+        if self.ttl is None:
+            return {}
+        return {'expire_at': expire_at(self.ttl)}
+
+    def _cache_put(self, user_id: str, document: dict) -> _Conversation:
+        conversation = None
+        if document is not None:
+            conversation = _Conversation(document.get('system_message'), self._max_turns())
+            for message in document.get('messages', []):
+                turn = _Turn(message['role'], message['content'])
+                turn.tokens = message.get('tokens')
+                conversation.turns.append(turn)
+        with self._lock:
+            self._cache[user_id] = (time.monotonic(), conversation)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return conversation
+
+    def _cache_drop(self, user_id: str):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def _load(self, user_id: str) -> _Conversation:
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None and time.monotonic() - cached[0] <= self.cache_ttl:
+                self._counters['cache_hits'] += 1
+                return cached[1]
+            self._counters['cache_misses'] += 1
+        document = self.collection.find_one({'user_id': user_id}, {'_id': 0})
+        if document is not None and is_expired(document):
+            document = None
+        return self._cache_put(user_id, document)
 
     def change_system_message(self, user_id, system_message):
-        self.system_messages[user_id] = system_message
-        self.remove(user_id)
+        self.collection.update_one(
+            {'user_id': user_id},
+            {'$set': {'system_message': system_message, 'messages': [], **self._expire_at()}},
+            upsert=True)
+        self._cache_drop(user_id)
 
     def append(self, user_id: str, role: str, content: str) -> None:
-        if self.storage[user_id] == []:
-            self._initialize(user_id)
-        self.storage[user_id].append({
-            'role': role,
-            'content': content
-        })
-        self._drop_message(user_id)
+        message = {'role': role, 'content': content}
+        if self.model_engine is not None:
+            message['tokens'] = MESSAGE_OVERHEAD + count_tokens(content, self.model_engine)
+        messages = {'$ifNull': ['$messages', []]}
+        reset = {}
+        if self.ttl is not None:
+            # A conversation past its expiry starts over.
+            expired = expired_expression(datetime.datetime.utcnow())
+            messages = {'$cond': [expired, [], messages]}
+            reset = {'system_message': {'$cond': [expired, None, '$system_message']}}
+        document = find_one_and_update_after(
+            self.collection,
+            {'user_id': user_id},
+            [
+                # $literal keeps a message starting with '$' from being read as a field path.
+                {'$set': {'messages': {'$concatArrays': [messages, {'$literal': [message]}]}, **reset}},
+                {'$set': {'messages': {'$slice': ['$messages', -self._max_turns()]}, **self._expire_at()}},
+            ],
+            projection={'_id': 0},
+            upsert=True)
+        self._cache_put(user_id, document)
 
-    def get(self, user_id: str) -> str:
-        return self.storage[user_id]
+    def get(self, user_id: str, model_engine: str = None) -> List[Dict]:
+        conversation = self._load(user_id)
+        if conversation is None or not conversation.turns:
+            return []
+        return _to_messages(
+            conversation, self.default_system_message,
+            _token_budget(self.token_budgets, model_engine), model_engine)
 
     def remove(self, user_id: str) -> None:
-        self.storage[user_id] = []
+        self.collection.update_one({'user_id': user_id}, {'$set': {'messages': []}})
+        self._cache_drop(user_id)
+
+    def count(self) -> int:
+        """
+        Number of stored conversations, from the collection metadata.
+        """
+        return self.collection.estimated_document_count()
+
+    def stats(self) -> Dict:
+        """
+        Number of stored conversations and local cache usage.
+        """
+        with self._lock:
+            return {
+                'users': self.collection.estimated_document_count(),
+                'cached_users': len(self._cache),
+                **self._counters
+            }
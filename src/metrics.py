@@ -0,0 +1,204 @@
+"""
+metrics.py
+"""
+
+import bisect
+import functools
+import threading
+import time
+from typing import Callable, Dict
+
+# Upper bounds in seconds of the stage duration histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_DESCRIPTIONS = {
+    'stage_duration_seconds': 'Time spent in each stage of answering a message.',
+    'errors_total': 'Failed turns by error class.',
+    'openai_tokens_total': 'Tokens reported in the usage of OpenAI responses.',
+}
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'started_at')
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started_at)
+        return False
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """
+    Stage latency histograms, labelled counters and gauges, rendered in
+    the Prometheus text exposition format.
+
+    Stages are timed with `stage` as a context manager or `timed` as a
+    decorator. While `enabled` is False nothing is recorded: `stage` hands
+    out a shared no-op context manager and `timed` calls straight through.
+    """
+
+    def __init__(self, enabled: bool = False, buckets=DEFAULT_BUCKETS, prefix: str = 'chatbot'):
+        """
+        Initialize the Metrics instance.
+
+        Params:
+            enabled: bool. Whether anything is recorded.
+            buckets: tuple. Upper bounds in seconds of the histogram buckets.
+            prefix: str. Prepended to every metric name.
+        """
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name: str):
+        """
+        Context manager timing one run of the stage `name`.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def timed(self, name: str) -> Callable:
+        """
+        Decorator timing every call of the function as the stage `name`.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with _Stage(self, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe(self, name: str, seconds: float):
+        """
+        Record one run of the stage `name` that took `seconds`.
+        """
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Add `value` to the counter `name` with the given labels.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def record_usage(self, usage: Dict):
+        """
+        Count the tokens of the `usage` field of an OpenAI response.
+        """
+        if not self.enabled or not usage:
+            return
+        for kind in ('prompt', 'completion'):
+            if usage.get(f'{kind}_tokens'):
+                self.count('openai_tokens_total', usage[f'{kind}_tokens'], type=kind)
+
+    def gauge(self, name: str, callback: Callable[[], float], description: str = ''):
+        """
+        Register a gauge whose value is read from `callback` on every render.
+        """
+        with self._lock:
+            self._gauges[name] = (callback, description)
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            histograms = {
+                name: (list(counts), total, count)
+                for name, (counts, total, count) in self._histograms.items()}
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+
+        lines = []
+        if histograms:
+            name = f'{self.prefix}_stage_duration_seconds'
+            lines.append(f'# HELP {name} {_DESCRIPTIONS["stage_duration_seconds"]}')
+            lines.append(f'# TYPE {name} histogram')
+            for stage, (counts, total, count) in sorted(histograms.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    labels = _format_labels((('stage', stage), ('le', _format_value(float(bound)))))
+                    lines.append(f'{name}_bucket{labels} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels((("stage", stage), ("le", "+Inf")))} {count}')
+                lines.append(f'{name}_sum{_format_labels((("stage", stage),))} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels((("stage", stage),))} {count}')
+
+        described = set()
+        for (counter, labels), value in sorted(counters.items()):
+            name = f'{self.prefix}_{counter}'
+            if counter not in described:
+                described.add(counter)
+                lines.append(f'# HELP {name} {_DESCRIPTIONS.get(counter, counter)}')
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        for gauge, (callback, description) in sorted(gauges.items()):
+            # pylint: disable=broad-exception-caught
+            try:
+                value = callback()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            name = f'{self.prefix}_{gauge}'
+            lines.append(f'# HELP {name} {description or gauge}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,49 @@
+"""
+migrate.py
+
+    python -m src.migrate
+
+Prepare the `user_log` table for index queries: add the day bucket to the
+logs written before it existed, then create the global secondary indexes
+`DynamoDBLogHandler.query_log` reads from and wait until they are active.
+Running it again only does what is still missing.
+
+Until both indexes are active the app reads logs with Scan, unless
+DYNAMODB_LOG_QUERY forces a mode.
+"""
+
+import argparse
+import os
+
+from dotenv import load_dotenv
+
+from src.models import DynamoDBLogHandler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[1])
+    parser.add_argument('--region', default=None,
+                        help='AWS region of the table, defaults to us-west-1 like the app.')
+    parser.add_argument('--skip-backfill', action='store_true',
+                        help='Only create the indexes.')
+    args = parser.parse_args(argv)
+
+    load_dotenv('.env')
+    # pylint: disable=import-outside-toplevel
+    import boto3
+
+    resource = boto3.session.Session(
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        region_name=args.region or 'us-west-1'
+    ).resource('dynamodb')
+    db_logger = DynamoDBLogHandler(resource, indexed=True)
+
+    if not args.skip_backfill:
+        print(f'Added the day bucket to {db_logger.backfill_day_buckets()} logs.')
+    db_logger.create_indexes()
+    print(f'{db_logger.USER_INDEX} and {db_logger.DAY_INDEX} are active.')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,68 @@
 models.py
 """
 
+import atexit
+import base64
+import datetime
+import json
 import logging
-import re
-from typing import List, Dict
+import queue
+import random
+import threading
+import time
+from decimal import Decimal
+from typing import List, Dict, Iterator, Tuple
 
-import requests
-from botocore.exceptions import ClientError
-import pandas as pd
+from botocore.exceptions import BotoCoreError, ClientError
+
+from src.cache import TTLCache
+from src.metrics import metrics
+from src.transport import HTTPTransport, get_shared_transport
 
 logger = logging.getLogger(__name__)
 
+# Asia/Taipei has no daylight saving time, a fixed offset is enough.
+TAIPEI_TZ = datetime.timezone(datetime.timedelta(hours=8), 'Asia/Taipei')
+
+
+def format_timestamp(timestamp) -> str:
+    """
+    Format an epoch timestamp as Taipei local time.
+    """
+    return datetime.datetime.fromtimestamp(int(timestamp), TAIPEI_TZ).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def encode_cursor(state: Dict) -> str:
+    """
+    Wrap a page position (day bucket and LastEvaluatedKey) into an opaque token.
+    """
+    data = json.dumps(state, default=_json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Dict:
+    """
+    Unwrap a token made by `encode_cursor`.
+
+    Raises:
+        ValueError if the cursor is malformed.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        # DynamoDB takes numbers as Decimal.
+        state = json.loads(data, parse_float=Decimal)
+    except (TypeError, ValueError) as err:
+        raise ValueError('Invalid cursor.') from err
+    if not isinstance(state, dict):
+        raise ValueError('Invalid cursor.')
+    return state
+
 # pylint: disable=missing-function-docstring,
 
 
@@ -55,20 +107,28 @@ class OpenAIModel(ModelInterface):
     Inherits from ModelInterface.
     """
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, transport: HTTPTransport = None):
         """
         Initialize the OpenAIModel instance.
 
         Args:
             api_key: str. The API key for accessing the OpenAI API.
+            transport: HTTPTransport. Pooled client to send requests with,
+                the process-wide shared transport if not given.
         """
         self.api_key = api_key
         self.base_url = 'https://api.openai.com/v1'
         self.headers = {
             'Authorization': f'Bearer {self.api_key}'
         }
+        self.transport = transport or get_shared_transport()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def _track(self, delta: int):
+        with self._lock:
+            self.in_flight += delta
 
-    # pylint: disable=missing-timeout
     def _request(self, method: str, endpoint: str, body=None, files=None):
         """
         Send a request to the OpenAI API.
@@ -82,16 +142,18 @@ class OpenAIModel(ModelInterface):
         Returns:
             Tuple containing success status (bool), response data (dict), and error message (str).
         """
+        self._track(1)
         try:
             if method == 'GET':
-                response = requests.get(
-                    f'{self.base_url}{endpoint}', headers=self.headers)
+                response = self.transport.request(
+                    'GET', f'{self.base_url}{endpoint}', headers=self.headers)
             elif method == 'POST':
+                headers = dict(self.headers)
                 if body:
-                    self.headers['Content-Type'] = 'application/json'
-                response = requests.post(
-                    f'{self.base_url}{endpoint}',
-                    headers=self.headers, json=body, files=files)
+                    headers['Content-Type'] = 'application/json'
+                response = self.transport.request(
+                    'POST', f'{self.base_url}{endpoint}',
+                    headers=headers, json=body, files=files)
             response = response.json()
             if response.get('error'):
                 return False, None, response.get('error', {}).get('message')
@@ -99,6 +161,8 @@ class OpenAIModel(ModelInterface):
         # pylint: disable=broad-exception-caught
         except Exception:
             return False, None, 'OpenAI API 系統不穩定，請稍後再試'
+        finally:
+            self._track(-1)
         return True, response, None
 
     def check_token_valid(self):
@@ -125,23 +189,178 @@ class OpenAIModel(ModelInterface):
             'model': model_engine,
             'messages': messages
         }
-        return self._request('POST', '/chat/completions', body=json_body)
+        is_successful, response, error_message = \
+            self._request('POST', '/chat/completions', body=json_body)
+        if is_successful:
+            metrics.record_usage(response.get('usage'))
+        return is_successful, response, error_message
+
+    def chat_completions_stream(self, messages: List[Dict], model_engine: str):
+        """
+        Get chat completions from the OpenAI model as a stream of content deltas.
+
+        Args:
+            messages: List of message dictionaries.
+            model_engine: str. The model engine to use for chat completions.
+
+        Returns:
+            Tuple containing success status (bool), an iterator of content
+            deltas (str), and error message (str). The request counts as in
+            flight until the iterator is exhausted or closed.
+        """
+        json_body = {
+            'model': model_engine,
+            'messages': messages,
+            'stream': True,
+            # The last chunk then carries the token usage.
+            'stream_options': {'include_usage': True}
+        }
+        headers = dict(self.headers)
+        headers['Content-Type'] = 'application/json'
+        self._track(1)
+        try:
+            response = self.transport.request(
+                'POST', f'{self.base_url}/chat/completions',
+                headers=headers, json=json_body, stream=True)
+            if response.status_code == 200:
+                return True, self._tracked_stream(response), None
+            error = response.json().get('error') or {}
+            error_message = error.get('message') or response.reason
+        # pylint: disable=broad-exception-caught
+        except Exception:
+            error_message = 'OpenAI API 系統不穩定，請稍後再試'
+        self._track(-1)
+        return False, None, error_message
+
+    def _tracked_stream(self, response) -> Iterator[str]:
+        try:
+            yield from self._iter_stream(response)
+        finally:
+            self._track(-1)
+
+    @staticmethod
+    def _iter_stream(response) -> Iterator[str]:
+        """
+        Yield the content deltas of a server-sent event stream.
+        """
+        # text/event-stream has no charset, requests would fall back to latin-1.
+        response.encoding = 'utf-8'
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    return
+                chunk = json.loads(data)
+                if chunk.get('error'):
+                    raise RuntimeError(chunk['error'].get('message'))
+                if chunk.get('usage'):
+                    metrics.record_usage(chunk['usage'])
+                for choice in chunk.get('choices', []):
+                    content = choice.get('delta', {}).get('content')
+                    if content:
+                        yield content
 
 
 class DynamoDBLogHandler:
     """
     A class for reading and writing logs to a DynamoDB table.
+
+    boto3 resources are not thread-safe. Given a callable creating one
+    instead of a resource, every thread uses a resource of its own.
     """
 
-    def __init__(self, resource):
+    TABLE_NAME = 'user_log'
+    # BatchWriteItem accepts at most 25 put requests.
+    MAX_BATCH_SIZE = 25
+    # Global secondary indexes `query_log` reads from, see `create_indexes`.
+    USER_INDEX = 'user_id-timestamp-index'
+    DAY_INDEX = 'day-timestamp-index'
+    # Seconds between checks for the indexes while they are missing.
+    INDEX_CHECK_INTERVAL = 300
+
+    def __init__(self,
+                 resource,
+                 buffered: bool = False,
+                 batch_size: int = MAX_BATCH_SIZE,
+                 flush_interval: float = 1,
+                 max_buffer_size: int = 10000,
+                 max_retries: int = 5,
+                 indexed: bool = None,
+                 lookback_days: int = 30,
+                 query_cache_ttl: float = 0,
+                 query_cache_size: int = 128):
         """
         Initialize the DynamoDBLogHandler instance.
 
         Params:
-            resource: A Boto3 DynamoDB resource.
+            resource: A Boto3 DynamoDB resource, or a callable creating one per thread.
+            buffered: bool. Write logs behind from a background thread
+                instead of on the caller's thread.
+            batch_size: int. Items per BatchWriteItem, at most 25.
+            flush_interval: float. Seconds a buffered log may wait for a batch to fill.
+            max_buffer_size: int. Buffered logs before `write_log` falls back to writing inline.
+            max_retries: int. Retries of unprocessed items per batch.
+            indexed: bool. Read logs with Query on the indexes instead of Scan,
+                None to do so once both indexes are active, see `src.migrate`.
+            lookback_days: int. Day buckets searched when no start timestamp is given.
+            query_cache_ttl: float. Seconds a query result is reused, 0 disables the cache.
+            query_cache_size: int. Query results kept in the cache.
+        """
+        self._resource = None if callable(resource) else resource
+        self._resource_factory = resource if callable(resource) else None
+        self._local = threading.local()
+
+        self.buffered = buffered
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.indexed = indexed
+        self._indexes_ready = False
+        self._indexes_checked_at = None
+        self.lookback_days = lookback_days
+        self.query_cache = None
+        if query_cache_ttl > 0:
+            self.query_cache = TTLCache(max_size=query_cache_size, ttl=query_cache_ttl)
+        self._buffer = queue.Queue(maxsize=max_buffer_size)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._counters = {
+            'written': 0,
+            'batches': 0,
+            'retries': 0,
+            'failed': 0,
+        }
+        self._key_names = None
+        self._writer = None
+        if buffered:
+            self._writer = threading.Thread(
+                target=self._write_behind, name='dynamodb-log-writer', daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    @property
+    def resource(self):
         """
-        self.resource = resource
-        self.table = self.resource.Table('user_log')
+        The DynamoDB resource of the calling thread.
+        """
+        if self._resource_factory is None:
+            return self._resource
+        resource = getattr(self._local, 'resource', None)
+        if resource is None:
+            resource = self._local.resource = self._resource_factory()
+        return resource
+
+    @property
+    def table(self):
+        """
+        The log table, through the resource of the calling thread.
+        """
+        table = getattr(self._local, 'table', None)
+        if table is None:
+            table = self._local.table = self.resource.Table(self.TABLE_NAME)
+        return table
 
     def write_log(self,
                   timestamp: int, user_id: str, prompt: str, input_text: str, output_text: str):
@@ -156,18 +375,234 @@ class DynamoDBLogHandler:
             output_text: string. the output text chatgpt gave.
 
         """
+        item = {
+            'timestamp': timestamp,
+            'user_id': user_id,
+            'day': self._day(timestamp).isoformat(),
+            'prompt': prompt,
+            'input_text': input_text,
+            'output_text': output_text}
+
+        if self.buffered and not self._closed:
+            try:
+                self._buffer.put_nowait(item)
+                return
+            except queue.Full:
+                logger.warning('Log buffer is full, writing inline.')
+
         try:
-            self.table.put_item(
-                Item={
-                    'timestamp': timestamp,
-                    'user_id': user_id,
-                    'prompt': prompt,
-                    'input_text': input_text,
-                    'output_text': output_text})
+            self.table.put_item(Item=item)
+            self._count('written')
+            self._update_query_cache([item])
 
         except ClientError as err:
             self._handle_error("write_log", err)
 
+    def _write_behind(self):
+        """
+        Drain the buffer in batches, a batch is sent once it is full or
+        `flush_interval` seconds after its first log arrived.
+        """
+        stopping = False
+        while not stopping:
+            item = self._buffer.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._buffer.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+
+    def _drain(self):
+        """
+        Write the logs left in the buffer on the calling thread.
+        """
+        batch = []
+        while True:
+            try:
+                item = self._buffer.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+            if len(batch) == self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    @property
+    def key_names(self) -> List[str]:
+        """
+        Attribute names of the table's primary key.
+        """
+        if self._key_names is None:
+            self._key_names = [key['AttributeName'] for key in self.table.key_schema]
+        return self._key_names
+
+    def _write_batch(self, items: List[Dict]):
+        """
+        Write items with BatchWriteItem, retrying unprocessed items with backoff.
+        Never raises, so a failing batch does not stop the writer.
+        """
+        self._count('batches')
+        # pylint: disable=broad-exception-caught
+        try:
+            # BatchWriteItem rejects a request holding the same key twice, the
+            # last item wins like it would with put_item.
+            unique = {tuple(item[key] for key in self.key_names): item for item in items}
+            dropped = self._write_requests(
+                [{'PutRequest': {'Item': item}} for item in unique.values()])
+        except Exception:
+            self._count('failed', len(items))
+            logger.exception('Dropped %d logs.', len(items))
+            return
+        dropped_items = [request['PutRequest']['Item'] for request in dropped]
+        self._update_query_cache(
+            [item for item in unique.values() if item not in dropped_items])
+
+    def _write_requests(self, put_requests: List[Dict]):
+        """
+        Send put requests until none is left unprocessed or retries run out.
+
+        Returns:
+            List of the put requests that were dropped.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.resource.batch_write_item(
+                    RequestItems={self.table.name: put_requests})
+            except ClientError as err:
+                logger.error(
+                    "Couldn't execute batch_write_item on table %s. %s: %s",
+                    self.table.name,
+                    err.response['Error']['Code'], err.response['Error']['Message'])
+                if err.response['Error']['Code'] == 'ValidationException':
+                    # The same request would be rejected again.
+                    break
+            except BotoCoreError as err:
+                logger.error(
+                    "Couldn't execute batch_write_item on table %s. %s",
+                    self.table.name, err)
+            else:
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table.name, [])
+                self._count('written', len(put_requests) - len(unprocessed))
+                put_requests = unprocessed
+                if not put_requests:
+                    return []
+            if attempt < self.max_retries:
+                self._count('retries')
+                time.sleep(random.uniform(0, min(5, 0.05 * 2 ** attempt)))
+
+        self._count('failed', len(put_requests))
+        logger.error('Dropped %d logs after %d attempts.', len(put_requests), attempt + 1)
+        return put_requests
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _update_query_cache(self, items: List[Dict]):
+        """
+        Add new items to the cached first pages they belong to, so the
+        latest logs stay cached under constant writes. Later pages they
+        could belong to are dropped, their position can not be patched.
+        Scanned pages are only patched when they hold every matching log.
+        """
+        if self.query_cache is None:
+            return
+        indexed = self.indexed if self.indexed is not None else self._indexes_ready
+        key_names = None
+        if indexed:
+            try:
+                key_names = set(self.key_names)
+            except (BotoCoreError, ClientError):
+                pass
+
+        def update(key, page):
+            from_timestamp, to_timestamp, user_id, limit, cursor = key
+            new = [
+                item for item in items
+                if (from_timestamp is None or from_timestamp <= item['timestamp']) and
+                (to_timestamp is None or item['timestamp'] <= to_timestamp) and
+                (user_id is None or user_id == item['user_id'])]
+            if not new:
+                return page
+            if cursor is not None:
+                return None
+            data, next_cursor = page
+            if not indexed and next_cursor is not None:
+                # Scan pages follow the table order, a new log may belong to any of them.
+                return None
+            # A log written again with the same key replaces the old one.
+            replaced = {(item['user_id'], item['timestamp']) for item in new}
+            data = sorted(
+                [row for row in data if (row['user_id'], row['timestamp']) not in replaced] + new,
+                key=lambda row: row['timestamp'], reverse=True)
+            if len(data) > limit:
+                if not indexed or key_names is None:
+                    return None
+                # The next page starts after the new last log.
+                data = data[:limit]
+                next_cursor = self._cursor_after(data[-1], user_id, key_names)
+            return data, next_cursor
+
+        self.query_cache.update_each(update)
+
+    @staticmethod
+    def _cursor_after(item: Dict, user_id: str, key_names: set) -> str:
+        """
+        The cursor of the index query page starting after `item`.
+        """
+        if user_id is not None:
+            return encode_cursor({'key': {
+                name: item[name] for name in key_names | {'user_id', 'timestamp'}}})
+        return encode_cursor({'day': item['day'], 'key': {
+            name: item[name] for name in key_names | {'day', 'timestamp'}}})
+
+    def close(self, timeout: float = None):
+        """
+        Flush the buffered logs and stop the background writer.
+
+        Params:
+            timeout: float. Seconds to wait for the buffer to drain.
+        """
+        if self._writer is None or self._closed:
+            return
+        self._closed = True
+        while True:
+            try:
+                self._buffer.put_nowait(None)
+                break
+            except queue.Full:
+                # The writer is behind, write the backlog here instead of waiting for a free slot.
+                self._drain()
+        self._writer.join(timeout)
+        if not self._writer.is_alive():
+            # Logs that were buffered while `close` was being called.
+            self._drain()
+
+    def stats(self) -> Dict:
+        """
+        Buffer depth, write counters and query cache usage.
+        """
+        with self._lock:
+            stats = {
+                'buffered': self._buffer.qsize(),
+                **self._counters
+            }
+        if self.query_cache is not None:
+            stats['query_cache'] = self.query_cache.stats()
+        return stats
+
     def query_log(
             self,
             from_timestamp: int = None,
@@ -175,7 +610,13 @@ class DynamoDBLogHandler:
             user_id: str = None,
             limit: int = 100) -> List:
         """
-        Read chat logs from the table.
+        Read the latest chat logs from the table, newest first.
+
+        With the indexes the logs are read with Query on `USER_INDEX` when
+        `user_id` is given, otherwise on `DAY_INDEX` one day bucket at a
+        time, and reading stops as soon as `limit` logs are collected.
+        Without them a filtered Scan reads until `limit` logs are collected,
+        so only the logs within a page are newest first.
 
         Params:
             from_timestamp: int. Start timestamp for query range.
@@ -186,6 +627,186 @@ class DynamoDBLogHandler:
         Returns:
             List of log items.
         """
+        return self.query_log_page(from_timestamp, to_timestamp, user_id, limit)[0]
+
+    def query_log_page(
+            self,
+            from_timestamp: int = None,
+            to_timestamp: int = None,
+            user_id: str = None,
+            limit: int = 100,
+            cursor: str = None) -> Tuple[List, str]:
+        """
+        Read one page of chat logs, newest first.
+
+        Params:
+            from_timestamp: int. Start timestamp for query range.
+            to_timestamp: int. End timestamp for query range.
+            user_id: string. User's id.
+            limit: int. Row count returned.
+            cursor: string. The cursor returned with the previous page.
+
+        Returns:
+            Tuple containing the log items (List) and the cursor of the
+            next page (str), None when there are no more logs.
+
+        Raises:
+            ValueError if the cursor is malformed.
+        """
+        key = (from_timestamp, to_timestamp, user_id, limit, cursor)
+        cached = self.query_cache.get(key) if self.query_cache is not None else None
+        if cached is not None:
+            return list(cached[0]), cached[1]
+
+        try:
+            data, next_cursor = self._query_log_page(
+                from_timestamp, to_timestamp, user_id, limit, cursor)
+        except ClientError as err:
+            if cursor is not None and err.response['Error']['Code'] == 'ValidationException':
+                # The start key of a tampered cursor does not fit the table.
+                raise ValueError('Invalid cursor.') from err
+            raise
+        if self.query_cache is not None:
+            self.query_cache.set(key, (data, next_cursor))
+        return list(data), next_cursor
+
+    def _query_log_page(self, from_timestamp: int, to_timestamp: int, user_id: str,
+                        limit: int, cursor: str) -> Tuple[List, str]:
+        # Importing boto3 takes a while, it is left to the first query.
+        # pylint: disable=import-outside-toplevel
+        from boto3.dynamodb.conditions import Key
+
+        state = decode_cursor(cursor) if cursor else {}
+        if not all(isinstance(state.get(name, {}), dict) for name in ('key', 'scan')):
+            raise ValueError('Invalid cursor.')
+        if 'day' in state:
+            try:
+                datetime.date.fromisoformat(state['day'])
+            except TypeError as err:
+                raise ValueError('Invalid cursor.') from err
+        if not self._use_indexes():
+            data, last_key = self._scan_query(
+                from_timestamp, to_timestamp, user_id, limit, state.get('scan'))
+            return data, encode_cursor({'scan': last_key}) if last_key else None
+
+        try:
+            if user_id is not None:
+                data, last_key = self._query_index(
+                    self.USER_INDEX, Key('user_id').eq(user_id),
+                    from_timestamp, to_timestamp, limit, state.get('key'))
+                return data, encode_cursor({'key': last_key}) if last_key else None
+
+            data = []
+            start_key = state.get('key')
+            for day in self._day_buckets(from_timestamp, to_timestamp, state.get('day')):
+                if len(data) >= limit:
+                    return data, encode_cursor({'day': day})
+                items, last_key = self._query_index(
+                    self.DAY_INDEX, Key('day').eq(day),
+                    from_timestamp, to_timestamp, limit - len(data), start_key)
+                start_key = None
+                data.extend(items)
+                if last_key:
+                    return data, encode_cursor({'day': day, 'key': last_key})
+            return data, None
+        except ClientError as err:
+            self._handle_error("query_log", err)
+
+    def _query_index(self, index_name: str, key_condition,
+                     from_timestamp: int, to_timestamp: int, limit: int,
+                     start_key: Dict = None) -> Tuple[List, Dict]:
+        """
+        Query an index newest first until `limit` items are collected.
+
+        Returns:
+            Tuple containing the items (List) and the key to continue
+            from (Dict), None when the index has no more matching items.
+        """
+        # pylint: disable=import-outside-toplevel
+        from boto3.dynamodb.conditions import Key
+
+        if from_timestamp is not None and to_timestamp is not None:
+            key_condition &= Key('timestamp').between(from_timestamp, to_timestamp)
+        elif from_timestamp is not None:
+            key_condition &= Key('timestamp').gte(from_timestamp)
+        elif to_timestamp is not None:
+            key_condition &= Key('timestamp').lte(to_timestamp)
+
+        query_params = {
+            'IndexName': index_name,
+            'KeyConditionExpression': key_condition,
+            'ScanIndexForward': False,
+        }
+        if start_key:
+            query_params['ExclusiveStartKey'] = start_key
+        data, last_key = [], None
+        while len(data) < limit:
+            response = self.table.query(Limit=limit - len(data), **query_params)
+            data.extend(response['Items'])
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                break
+            query_params['ExclusiveStartKey'] = last_key
+        return data, last_key
+
+    def _use_indexes(self) -> bool:
+        if self.indexed is not None:
+            return self.indexed
+        now = time.monotonic()
+        if not self._indexes_ready and (
+                self._indexes_checked_at is None or
+                now - self._indexes_checked_at >= self.INDEX_CHECK_INTERVAL):
+            self._indexes_checked_at = now
+            try:
+                self._indexes_ready = self.indexes_ready()
+            except (BotoCoreError, ClientError) as err:
+                logger.warning("Couldn't describe table %s: %s", self.TABLE_NAME, err)
+            if not self._indexes_ready:
+                logger.info('Log indexes are not active, reading logs with Scan.')
+        return self._indexes_ready
+
+    def indexes_ready(self) -> bool:
+        """
+        Whether both indexes `query_log` reads from exist and are active.
+        """
+        self.table.reload()
+        active = {index['IndexName'] for index in self.table.global_secondary_indexes or []
+                  if index.get('IndexStatus') == 'ACTIVE'}
+        return {self.USER_INDEX, self.DAY_INDEX} <= active
+
+    def _day_buckets(self, from_timestamp: int = None, to_timestamp: int = None,
+                     start_day: str = None):
+        """
+        Day buckets from `to_timestamp` (or now) back to `from_timestamp`,
+        or back `lookback_days` days when there is no start.
+        Buckets newer than `start_day` are skipped.
+        """
+        day = self._day(int(time.time()) if to_timestamp is None else to_timestamp)
+        if from_timestamp is not None:
+            first = self._day(from_timestamp)
+        else:
+            first = day - datetime.timedelta(days=self.lookback_days - 1)
+        if start_day is not None:
+            day = min(day, datetime.date.fromisoformat(start_day))
+        while day >= first:
+            yield day.isoformat()
+            day -= datetime.timedelta(days=1)
+
+    @staticmethod
+    def _day(timestamp: int) -> datetime.date:
+        return datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone.utc).date()
+
+    def _scan_query(self, from_timestamp: int, to_timestamp: int, user_id: str,
+                    limit: int, start_key: Dict = None) -> Tuple[List, Dict]:
+        """
+        Read chat logs with a filtered Scan, for tables without the indexes.
+        Scanning stops once `limit` logs are collected. Pages follow the
+        table order, only the logs within a page are sorted newest first.
+
+        Returns:
+            Tuple containing the items (List) and the key to continue
+            from (Dict), None when the table has no more items.
+        """
         # Build the filter expression and expression attribute values based on the input parameters
         filter_expression = []
         expression_attribute_values = {}
@@ -203,17 +824,83 @@ class DynamoDBLogHandler:
             expression_attribute_values[":user_id"] = user_id
 
         # Construct the query parameters
-        query_params = {
-            "FilterExpression": " AND ".join(filter_expression),
-            "ExpressionAttributeNames": {"#ts": "timestamp"},
-            "ExpressionAttributeValues": expression_attribute_values,
-            "Limit": limit
-        }
+        query_params = {}
+        if start_key:
+            query_params["ExclusiveStartKey"] = start_key
+        if filter_expression:
+            query_params.update({
+                "FilterExpression": " AND ".join(filter_expression),
+                "ExpressionAttributeValues": expression_attribute_values,
+            })
+            if from_timestamp is not None or to_timestamp is not None:
+                query_params["ExpressionAttributeNames"] = {"#ts": "timestamp"}
 
         try:
-            return self.scan_log(query_params)
+            data, last_key = [], None
+            while len(data) < limit:
+                # Limit counts the items read, so a page never overshoots `limit`.
+                response = self.table.scan(Limit=limit - len(data), **query_params)
+                data.extend(response['Items'])
+                last_key = response.get('LastEvaluatedKey')
+                if not last_key:
+                    break
+                query_params['ExclusiveStartKey'] = last_key
         except ClientError as err:
             self._handle_error("query_log", err)
+        data.sort(key=lambda item: item['timestamp'], reverse=True)
+        return data, last_key
+
+    def create_indexes(self):
+        """
+        Create the missing global secondary indexes `query_log` reads from.
+        Run `backfill_day_buckets` first, logs without a day bucket are
+        left out of `DAY_INDEX`. Both are run by `python -m src.migrate`.
+        DynamoDB only takes one index creation per UpdateTable call, so
+        each one is awaited before the next.
+        """
+        existing = {index['IndexName'] for index in self.table.global_secondary_indexes or []}
+        for index_name, hash_key in ((self.USER_INDEX, 'user_id'), (self.DAY_INDEX, 'day')):
+            if index_name in existing:
+                continue
+            self.table.update(
+                AttributeDefinitions=[
+                    {'AttributeName': hash_key, 'AttributeType': 'S'},
+                    {'AttributeName': 'timestamp', 'AttributeType': 'N'}],
+                GlobalSecondaryIndexUpdates=[{'Create': {
+                    'IndexName': index_name,
+                    'KeySchema': [
+                        {'AttributeName': hash_key, 'KeyType': 'HASH'},
+                        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+                    'Projection': {'ProjectionType': 'ALL'}}}])
+            while True:
+                self.table.reload()
+                statuses = [index['IndexStatus'] for index in self.table.global_secondary_indexes or []
+                            if index['IndexName'] == index_name]
+                if statuses and statuses[0] == 'ACTIVE':
+                    break
+                time.sleep(5)
+
+    def backfill_day_buckets(self) -> int:
+        """
+        Add the `day` attribute to logs written before it existed,
+        so they show up in `DAY_INDEX`.
+
+        Returns:
+            int. Number of logs updated.
+        """
+        # pylint: disable=import-outside-toplevel
+        from boto3.dynamodb.conditions import Attr
+
+        keys = [key['AttributeName'] for key in self.table.key_schema]
+        updated = 0
+        for item in self.scan_log({'FilterExpression': Attr('day').not_exists()}):
+            self.table.update_item(
+                Key={key: item[key] for key in keys},
+                UpdateExpression='SET #day = :day',
+                ExpressionAttributeNames={'#day': 'day'},
+                ExpressionAttributeValues={':day': self._day(item['timestamp']).isoformat()})
+            updated += 1
+        return updated
 
     def scan_log(self, query_params: Dict = None) -> List:
         """
@@ -231,7 +918,7 @@ class DynamoDBLogHandler:
             data = response['Items']
             while 'LastEvaluatedKey' in response:
                 response = self.table.scan(
-                    ExclusiveStartKey=response['LastEvaluatedKey'])
+                    ExclusiveStartKey=response['LastEvaluatedKey'], **query_params)
                 data.extend(response['Items'])
             return data
         except ClientError as err:
@@ -252,20 +939,3 @@ class DynamoDBLogHandler:
 
         # pylint: disable=misplaced-bare-raise
         raise
-
-    def get_log_html_body(self, limit=20):
-        """
-        get logs and turn into html.
-        """
-        data = self.query_log(limit)
-        data = pd.DataFrame(
-            data)[['timestamp', 'user_id', 'prompt', 'input_text', 'output_text']]
-        data = data.sort_values(by='timestamp', ascending=False)
-        data['timestamp'] = data['timestamp'].apply(
-            lambda x:
-            pd.to_datetime(int(x), unit='s', utc=True).tz_convert('Asia/Taipei').strftime('%Y-%m-%d %H:%M:%S'))
-        tbody = data.to_html(header=False, index=False)
-        tbody = re.sub('<table border="1" class="dataframe">', '', tbody)
-        tbody = re.sub('</table>', '', tbody)
-        tbody = re.sub('\n', '', tbody)
-        return tbody
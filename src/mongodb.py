@@ -1,6 +1,70 @@
+import datetime
 import os
 
-from pymongo import MongoClient
+# Documents carry an `expire_at` date and are removed by a TTL index, see
+# `create_ttl_index`. MongoDB's TTL monitor only runs about once a minute,
+# so an expired document may still be found: readers check `expire_at`
+# themselves with `is_expired`, `expired_filter` or `expired_expression`.
+
+
+def create_ttl_index(collection):
+    collection.create_index('expire_at', expireAfterSeconds=0)
+
+
+def expire_at(ttl: float) -> datetime.datetime:
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+
+
+def is_expired(document: dict) -> bool:
+    """
+    Whether a document read from the collection is past its `expire_at`.
+    """
+    return document.get('expire_at') is not None and \
+        document['expire_at'] < datetime.datetime.utcnow()
+
+
+def expired_filter(now: datetime.datetime) -> dict:
+    """
+    Query filter matching the documents past their `expire_at` at `now`.
+    """
+    return {'expire_at': {'$lt': now}}
+
+
+def expired_expression(now: datetime.datetime) -> dict:
+    """
+    Aggregation expression, for pipeline updates, true when the document
+    is past its `expire_at` at `now`. A document without one never expires.
+    """
+    return {'$lt': [{'$ifNull': ['$expire_at', now]}, now]}
+
+
+def find_one_and_update_after(collection, query: dict, update, **kwargs) -> dict:
+    """
+    `find_one_and_update` returning the document as it is after the update.
+    """
+    # Importing pymongo takes a while, only pay for it when MongoDB is used.
+    # pylint: disable=import-outside-toplevel
+    from pymongo import ReturnDocument
+
+    return collection.find_one_and_update(
+        query, update, return_document=ReturnDocument.AFTER, **kwargs)
+
+
+def insert_unique(collection, document: dict) -> bool:
+    """
+    Insert a document unless its unique key is taken.
+
+    Returns:
+        bool. False if a document with the same key exists.
+    """
+    # pylint: disable=import-outside-toplevel
+    from pymongo.errors import DuplicateKeyError
+
+    try:
+        collection.insert_one(document)
+        return True
+    except DuplicateKeyError:
+        return False
 
 
 class MongoDB():
@@ -13,6 +77,10 @@ class MongoDB():
     db: None
 
     def connect_to_database(self, mongo_path=None, db_name=None):
+        # Importing pymongo takes a while, only pay for it when MongoDB is used.
+        # pylint: disable=import-outside-toplevel
+        from pymongo import MongoClient
+
         mongo_path = mongo_path or os.getenv('MONGODB__PATH')
         db_name = db_name or os.getenv('MONGODB__DBNAME')
         self.client = MongoClient(mongo_path)
@@ -0,0 +1,140 @@
+"""
+ratelimit.py
+"""
+
+import threading
+import time
+from typing import Callable, Dict
+
+from src.cache import TTLCache
+from src.mongodb import create_ttl_index, expire_at, find_one_and_update_after
+
+
+class LimiterStoreInterface:
+    """
+    Where token buckets are kept, so that several processes can share them.
+    """
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1) -> bool:
+        """
+        Refill the bucket `key` at `rate` tokens per second up to `capacity`,
+        then take `cost` tokens from it.
+
+        Returns:
+            bool. False if the bucket did not hold enough tokens, nothing is taken then.
+        """
+        raise NotImplementedError
+
+
+class MemoryLimiterStore(LimiterStoreInterface):
+    """
+    Token buckets kept in this process.
+    """
+
+    def __init__(self, max_keys: int = 100000, clock: Callable[[], float] = time.monotonic):
+        self.buckets = TTLCache(max_size=max_keys)
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1) -> bool:
+        now = self.clock()
+        with self._lock:
+            tokens, updated_at = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            # A bucket left alone this long is full again, no need to keep it.
+            self.buckets.set(key, (tokens, now), ttl=(capacity - tokens) / rate)
+            return allowed
+
+
+class MongoLimiterStore(LimiterStoreInterface):
+    """
+    Token buckets kept in MongoDB, refilled and taken from atomically
+    with a single pipeline update.
+    """
+
+    def __init__(self, db, collection: str = 'rate_limit', clock: Callable[[], float] = time.time):
+        self.collection = db[collection]
+        self.clock = clock
+        create_ttl_index(self.collection)
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1) -> bool:
+        now = self.clock()
+        refilled = {'$min': [capacity, {'$add': [
+            {'$ifNull': ['$tokens', capacity]},
+            {'$multiply': [rate, {'$subtract': [now, {'$ifNull': ['$updated_at', now]}]}]}
+        ]}]}
+        document = find_one_and_update_after(
+            self.collection,
+            {'_id': key},
+            [
+                {'$set': {'tokens': refilled, 'updated_at': now}},
+                {'$set': {'allowed': {'$gte': ['$tokens', cost]}}},
+                {'$set': {
+                    'tokens': {'$cond': ['$allowed', {'$subtract': ['$tokens', cost]}, '$tokens']},
+                    'expire_at': expire_at(capacity / rate)
+                }},
+            ],
+            upsert=True)
+        return document['allowed']
+
+
+class RateLimiter:
+    """
+    Admission control in front of the model: a token bucket per user and
+    one shared by everybody. A bucket whose rate is None is not applied.
+    """
+
+    def __init__(self,
+                 store: LimiterStoreInterface,
+                 user_rate: float = None,
+                 user_burst: float = 5,
+                 global_rate: float = None,
+                 global_burst: float = 20):
+        """
+        Initialize the RateLimiter instance.
+
+        Params:
+            store: LimiterStoreInterface. Where the buckets are kept.
+            user_rate: float. Completions per second allowed for one user.
+            user_burst: float. Completions a user may make at once.
+            global_rate: float. Completions per second allowed for everybody.
+            global_burst: float. Completions everybody may make at once.
+        """
+        self.store = store
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self._lock = threading.Lock()
+        self._counters = {
+            'allowed': 0,
+            'limited_user': 0,
+            'limited_global': 0,
+        }
+
+    def allow(self, user_id: str) -> bool:
+        """
+        Take a token for one completion of `user_id`.
+        """
+        if self.user_rate and not self.store.take(f'user:{user_id}', self.user_rate, self.user_burst):
+            self._count('limited_user')
+            return False
+        if self.global_rate and not self.store.take('global', self.global_rate, self.global_burst):
+            self._count('limited_global')
+            return False
+        self._count('allowed')
+        return True
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict:
+        """
+        Allowed and limited completions.
+        """
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,94 @@
+"""
+registry.py
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from src.models import OpenAIModel
+from src.transport import HTTPTransport
+
+
+class ModelRegistry:
+    """
+    Hands out one shared `OpenAIModel` per distinct API key.
+
+    Every user without a key of their own gets the default key's model,
+    users who registered a key get a model of their own. Models of custom
+    keys are evicted least recently used first once `max_models` are kept,
+    the default one is never evicted. All models send their requests
+    through the same pooled transport.
+    """
+
+    def __init__(self,
+                 default_api_key: str,
+                 transport: HTTPTransport,
+                 key_resolver: Callable[[str], Optional[str]] = None,
+                 max_models: int = 1000):
+        """
+        Initialize the ModelRegistry instance.
+
+        Params:
+            default_api_key: str. Key used for users without their own key.
+            transport: HTTPTransport. Pooled transport shared by every model.
+            key_resolver: Callable returning the API key a user registered, or None.
+            max_models: int. Models of custom keys kept alive.
+        """
+        self.default_api_key = default_api_key
+        self.transport = transport
+        self.key_resolver = key_resolver
+        self.max_models = max_models
+        self.default_model = OpenAIModel(api_key=default_api_key, transport=transport)
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> OpenAIModel:
+        """
+        The model to answer a user with.
+        """
+        api_key = self.key_resolver(user_id) if self.key_resolver else None
+        if not api_key or api_key == self.default_api_key:
+            return self.default_model
+
+        with self._lock:
+            model = self._models.get(api_key)
+            if model is None:
+                model = OpenAIModel(api_key=api_key, transport=self.transport)
+                self._models[api_key] = model
+                while len(self._models) > self.max_models:
+                    self._models.popitem(last=False)
+            else:
+                self._models.move_to_end(api_key)
+            return model
+
+    def discard(self, api_key: str):
+        """
+        Drop the model of a key, e.g. after the key turned out to be invalid.
+        """
+        with self._lock:
+            self._models.pop(api_key, None)
+
+    def stats(self) -> Dict:
+        """
+        Live models, and the share of the connection pool used by the
+        default key and by the custom keys together. Keys are not shown.
+        """
+        with self._lock:
+            custom = list(self._models.values())
+        pool_size = self.transport.pool_size
+        default_in_flight = self.default_model.in_flight
+        custom_in_flight = [model.in_flight for model in custom if model.in_flight]
+        return {
+            'models': len(custom) + 1,
+            'pool_size': pool_size,
+            'default': {
+                'in_flight': default_in_flight,
+                'pool_saturation': default_in_flight / pool_size,
+            },
+            'custom': {
+                'busy_keys': len(custom_in_flight),
+                'in_flight': sum(custom_in_flight),
+                'pool_saturation': sum(custom_in_flight) / pool_size,
+            },
+        }
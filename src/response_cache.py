@@ -0,0 +1,191 @@
+"""
+response_cache.py
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import unicodedata
+from typing import Dict, List, Optional
+
+from src.cache import TTLCache
+from src.mongodb import create_ttl_index, expire_at, is_expired
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_TRAILING_PUNCTUATION = '.,!?~。，！？～…、 '
+
+
+def normalize(text: str) -> str:
+    """
+    Fold the differences that do not change what a short opener means:
+    width, case, runs of whitespace and trailing punctuation.
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    return _WHITESPACE_RE.sub(' ', text).strip().rstrip(_TRAILING_PUNCTUATION)
+
+
+class ResponseStoreInterface:
+    """
+    Where cached responses are kept, a list of variants per key.
+    """
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """
+        The variants stored for `key`, None if missing or expired.
+        """
+        raise NotImplementedError
+
+    def add(self, key: str, response: str, variants: int) -> None:
+        """
+        Add a variant to `key`, keeping the latest `variants` of them.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> Dict:
+        """
+        Size of the store.
+        """
+        raise NotImplementedError
+
+
+class MemoryResponseStore(ResponseStoreInterface):
+    """
+    Responses kept in this process.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = None, max_bytes: int = None):
+        self.entries = TTLCache(max_size=max_entries, ttl=ttl, max_bytes=max_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        return self.entries.get(key)
+
+    def add(self, key: str, response: str, variants: int) -> None:
+        with self._lock:
+            responses = (self.entries.get(key) or []) + [response]
+            responses = responses[-variants:]
+            size = sum(len(item.encode('utf-8')) for item in responses)
+            self.entries.set(key, responses, size=size)
+
+    def stats(self) -> Dict:
+        return self.entries.stats()
+
+
+class MongoResponseStore(ResponseStoreInterface):
+    """
+    Responses kept in MongoDB so every worker process shares them,
+    expired by a TTL index.
+    """
+
+    def __init__(self, db, ttl: float = None, collection: str = 'response_cache'):
+        self.collection = db[collection]
+        self.ttl = ttl
+        if ttl is not None:
+            create_ttl_index(self.collection)
+
+    def get(self, key: str) -> Optional[List[str]]:
+        document = self.collection.find_one({'_id': key})
+        if document is None or is_expired(document):
+            return None
+        return document['responses']
+
+    def add(self, key: str, response: str, variants: int) -> None:
+        update = {'$push': {'responses': {'$each': [response], '$slice': -variants}}}
+        if self.ttl is not None:
+            update['$set'] = {'expire_at': expire_at(self.ttl)}
+        self.collection.update_one({'_id': key}, update, upsert=True)
+
+    def stats(self) -> Dict:
+        return {'size': self.collection.estimated_document_count()}
+
+
+class ResponseCache:
+    """
+    Answers short, history-free turns from earlier completions of the
+    same prompt.
+
+    A turn is cacheable when the messages hold the system message and a
+    single user message of at most `max_prompt_length` characters. It is
+    keyed on the model engine, the system message and the normalized user
+    message. Up to `variants` different responses are collected per key,
+    a key is only served once all of them are there, and then one of them
+    is picked at random, so users do not all get the identical sentence.
+    """
+
+    def __init__(self, store: ResponseStoreInterface, max_prompt_length: int = 20, variants: int = 1):
+        """
+        Initialize the ResponseCache instance.
+
+        Params:
+            store: ResponseStoreInterface. Where the responses are kept.
+            max_prompt_length: int. Longest user message that is cached.
+            variants: int. Responses collected per key before it is served.
+        """
+        self.store = store
+        self.max_prompt_length = max_prompt_length
+        self.variants = max(1, variants)
+        self._lock = threading.Lock()
+        self._latency_total = 0.0
+        self._latency_count = 0
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'latency_saved': 0.0,
+        }
+
+    def key(self, model_engine: str, messages: List[Dict]) -> Optional[str]:
+        """
+        The cache key of a prompt.
+
+        Returns:
+            str. None if the prompt is not cacheable.
+        """
+        if len(messages) != 2 or messages[0]['role'] != 'system' or messages[1]['role'] != 'user':
+            return None
+        prompt = normalize(messages[1]['content'])
+        if not prompt or len(prompt) > self.max_prompt_length:
+            return None
+        payload = json.dumps([model_engine, messages[0]['content'], prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        A cached response for `key`, None if the model should be asked.
+        """
+        responses = self.store.get(key)
+        with self._lock:
+            if not responses or len(responses) < self.variants:
+                self._counters['misses'] += 1
+                return None
+            self._counters['hits'] += 1
+            if self._latency_count:
+                self._counters['latency_saved'] += self._latency_total / self._latency_count
+        return random.choice(responses)
+
+    def put(self, key: str, response: str, latency: float):
+        """
+        Store the response the model gave for `key` and how long it took.
+        """
+        with self._lock:
+            self._latency_total += latency
+            self._latency_count += 1
+        self.store.add(key, response, self.variants)
+
+    def stats(self) -> Dict:
+        """
+        Hit ratio, and the seconds saved estimated from the average latency
+        of the completions that were stored.
+        """
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            result = {
+                'hit_ratio': self._counters['hits'] / lookups if lookups else 0.0,
+                'variants': self.variants,
+                'average_latency': self._latency_total / self._latency_count
+                if self._latency_count else 0.0,
+                **self._counters
+            }
+        result['store'] = self.store.stats()
+        return result
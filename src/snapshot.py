@@ -0,0 +1,168 @@
+"""
+snapshot.py
+"""
+
+import json
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+MAGIC = b'ESBM'
+VERSION = 1
+# Magic, format version, flags, written at (unix time), number of records.
+HEADER = struct.Struct('>4sHHdI')
+# Last access (unix time), user id length, body length.
+RECORD = struct.Struct('>dHI')
+
+
+def encode_record(user_id: str, last_access: float, system_message: Optional[str],
+                  turns: Iterable[Tuple[str, str, Optional[int]]],
+                  summary: Optional[str] = None) -> bytes:
+    """
+    One length-prefixed record: the fixed header, the user id, then the
+    conversation as JSON.
+    """
+    user = user_id.encode('utf-8')
+    conversation = {'s': system_message, 't': [list(turn) for turn in turns]}
+    if summary:
+        conversation['m'] = summary
+    body = json.dumps(conversation,
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return RECORD.pack(last_access, len(user), len(body)) + user + body
+
+
+def write_snapshot(path: str, records: List[bytes]):
+    """
+    Write encoded records to `path` atomically, replacing the previous snapshot.
+    """
+    # Worker processes may share `path`, each writes its own temporary file.
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, 0, time.time(), len(records)))
+            for record in records:
+                file.write(record)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class SnapshotReader:
+    """
+    A snapshot mapped into memory and read on demand.
+
+    Opening only checks the header. The index of user ids is built on
+    the first lookup by walking the record headers, without decoding any
+    conversation, and a conversation is decoded when its user is taken.
+    A truncated or corrupt file raises ValueError when the index is built
+    (see `validate`) or when a corrupt record is taken.
+    Not thread-safe, the owner serializes access.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initialize the SnapshotReader instance.
+
+        Params:
+            path: str. The snapshot file.
+
+        Raises:
+            ValueError: The file is not a snapshot of a known version.
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError(f'{path} is too short to be a snapshot')
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.written_at, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f'{path} is not a version {VERSION} snapshot')
+        self._index = None
+
+    def _build_index(self) -> Dict[str, Tuple[int, int]]:
+        index = {}
+        position = HEADER.size
+        size = len(self._map)
+        for number in range(self.count):
+            if position + RECORD.size > size:
+                raise ValueError(f'{self.path} is truncated at record {number}')
+            _, user_length, body_length = RECORD.unpack_from(self._map, position)
+            start = position + RECORD.size
+            end = start + user_length + body_length
+            if end > size:
+                raise ValueError(f'{self.path} is truncated at record {number}')
+            user_id = self._map[start:start + user_length].decode('utf-8')
+            index[user_id] = (position, end)
+            position = end
+        return index
+
+    @property
+    def index(self) -> Dict[str, Tuple[int, int]]:
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    def validate(self):
+        """
+        Build the index now.
+
+        Raises:
+            ValueError: The records are truncated or corrupt.
+        """
+        self._index = self.index
+
+    def __len__(self) -> int:
+        return self.count if self._index is None else len(self._index)
+
+    def last_access(self, user_id: str) -> Optional[float]:
+        span = self.index.get(user_id)
+        return None if span is None else RECORD.unpack_from(self._map, span[0])[0]
+
+    def take(self, user_id: str):
+        """
+        Remove a user from the snapshot and decode their conversation.
+
+        Returns:
+            Tuple of the last access (float), the system message (str), the
+            turns (list of (role, content, tokens)) and the summary of older
+            turns (str), None if the user is not in the snapshot.
+
+        Raises:
+            ValueError: The record of the user is corrupt, it is removed anyway.
+        """
+        span = self.index.pop(user_id, None)
+        if span is None:
+            return None
+        position, end = span
+        last_access, user_length, _ = RECORD.unpack_from(self._map, position)
+        body = json.loads(self._map[position + RECORD.size + user_length:end].decode('utf-8'))
+        try:
+            turns = [(role, content, tokens) for role, content, tokens in body['t']]
+            return last_access, body['s'], turns, body.get('m')
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError(f'The record of {user_id} is corrupt') from error
+
+    def discard(self, user_id: str):
+        self.index.pop(user_id, None)
+
+    def pending(self, not_before: float = None) -> List[Tuple[int, int]]:
+        """
+        Spans of the records nobody took yet, last accessed at `not_before` or later.
+        """
+        return [
+            span for span in self.index.values()
+            if not_before is None or RECORD.unpack_from(self._map, span[0])[0] >= not_before]
+
+    def read(self, span: Tuple[int, int]) -> bytes:
+        return self._map[span[0]:span[1]]
+
+    def close(self):
+        self._map.close()
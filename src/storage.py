@@ -1,27 +1,75 @@
 import json
 import datetime
+import os
+import threading
+
+from src.cache import TTLCache
+
+_MISSING = object()
 
 
 class FileStorage:
-    def __init__(self, file_name):
+    """
+    Keeps the API keys in an append-only log, one JSON object of
+    `{user_id: api_key}` per line, replayed into `history` on load.
+    A save appends a line, and once the log holds `compact_ratio` times
+    more lines than users it is rewritten with one line per user.
+    """
+
+    def __init__(self, file_name, compact_ratio=2, compact_min_lines=1000):
         self.fine_name = file_name
+        self.compact_ratio = compact_ratio
+        self.compact_min_lines = compact_min_lines
         self.history = {}
+        self._lines = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _replay(self):
+        history, lines = {}, 0
+        if os.path.exists(self.fine_name):
+            with open(self.fine_name, newline='') as f:
+                for line in f:
+                    if line.strip():
+                        history.update(json.loads(line))
+                        lines += 1
+        self.history, self._lines, self._loaded = history, lines, True
+
+    def _compact(self):
+        temp_name = f'{self.fine_name}.tmp'
+        with open(temp_name, 'w', newline='') as f:
+            for user_id, api_key in self.history.items():
+                f.write(json.dumps({user_id: api_key}) + '\n')
+        os.replace(temp_name, self.fine_name)
+        self._lines = len(self.history)
 
     def save(self, data):
-        self.history.update(data)
-        with open(self.fine_name, 'w', newline='') as f:
-            json.dump(self.history, f)
+        with self._lock:
+            if not self._loaded:
+                self._replay()
+            with open(self.fine_name, 'a', newline='') as f:
+                f.write(json.dumps(data) + '\n')
+            self.history.update(data)
+            self._lines += 1
+            if self._lines > max(self.compact_min_lines, self.compact_ratio * len(self.history)):
+                self._compact()
 
     def load(self):
-        with open(self.fine_name, newline='') as jsonfile:
-            data = json.load(jsonfile)
-        self.history = data
-        return self.history
+        with self._lock:
+            self._replay()
+            return dict(self.history)
+
+    def get(self, user_id):
+        with self._lock:
+            if not self._loaded:
+                self._replay()
+            return self.history.get(user_id)
 
 
 class MongoStorage:
     def __init__(self, db):
         self.db = db
+        self.db['api_key'].create_index('user_id', unique=True)
 
     def save(self, data):
         user_id, api_key = list(data.items())[0]
@@ -42,13 +90,40 @@ class MongoStorage:
             res[data[i]['user_id']] = data[i]['api_key']
         return res
 
+    def get(self, user_id):
+        document = self.db['api_key'].find_one({'user_id': user_id}, {'_id': 0, 'api_key': 1})
+        return None if document is None else document['api_key']
+
 
 class Storage:
-    def __init__(self, storage):
+    """
+    Facade over a storage backend, with a read-through cache of the key
+    of every user looked up, users without a key included. Saves through
+    the facade update the cache, saves by other processes are seen once
+    the cached entry is older than `cache_ttl` seconds.
+    """
+
+    def __init__(self, storage, cache_size=10000, cache_ttl=60):
         self.storage = storage
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
 
     def save(self, data):
         self.storage.save(data)
+        for user_id, api_key in data.items():
+            self.cache.set(user_id, api_key)
 
     def load(self):
         return self.storage.load()
+
+    def get(self, user_id):
+        api_key = self.cache.get(user_id, _MISSING)
+        if api_key is _MISSING:
+            api_key = self.storage.get(user_id)
+            self.cache.set(user_id, api_key)
+        return api_key
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(user_id)
@@ -0,0 +1,123 @@
+"""
+summarize.py
+"""
+
+import logging
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+
+from src.models import OpenAIModel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROMPT = (
+    '請將以下的對話整理成一段簡短的摘要，用繁體中文，保留使用者的感受、處境、'
+    '提過的人事物與仍在意的事情，之後的對話會以這段摘要作為前情提要。只回覆摘要本身。'
+)
+
+_ROLE_NAMES = {'user': '使用者', 'assistant': '助理'}
+
+
+class Summarizer:
+    """
+    Summarizes the older turns of conversations with an `OpenAIModel`, on
+    a background thread so no request waits for it.
+
+    Jobs are queued with `submit` and their callback gets the summary, or
+    None if the model failed. A job that does not fit in the queue is
+    dropped without calling its callback.
+    """
+
+    def __init__(self, model: OpenAIModel, model_engine: str,
+                 prompt: str = DEFAULT_PROMPT, max_queue_size: int = 100):
+        """
+        Initialize the Summarizer instance.
+
+        Params:
+            model: OpenAIModel. Model writing the summaries, anything with
+                the same `chat_completions` works.
+            model_engine: str. The model engine to summarize with.
+            prompt: str. System message of the summarization request.
+            max_queue_size: int. Jobs allowed to wait for the worker.
+        """
+        self.model = model
+        self.model_engine = model_engine
+        self.prompt = prompt
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._counters = {
+            'summarized': 0,
+            'failed': 0,
+            'dropped': 0,
+        }
+        self._worker = threading.Thread(target=self._work, name='summarizer', daemon=True)
+        self._worker.start()
+
+    def summarize(self, summary: Optional[str], turns: List[Dict]) -> Optional[str]:
+        """
+        Fold `turns` into the previous `summary`.
+
+        Returns:
+            str. The new summary, None if the model failed.
+        """
+        lines = [f"{_ROLE_NAMES.get(turn['role'], turn['role'])}：{turn['content']}" for turn in turns]
+        content = '對話：\n' + '\n'.join(lines)
+        if summary:
+            content = f'先前的摘要：\n{summary}\n\n{content}'
+        is_successful, response, error_message = self.model.chat_completions(
+            [{'role': 'system', 'content': self.prompt}, {'role': 'user', 'content': content}],
+            self.model_engine)
+        if not is_successful:
+            logger.warning('Summarization failed: %s', error_message)
+            return None
+        return response['choices'][0]['message']['content'].strip() or None
+
+    def submit(self, summary: Optional[str], turns: List[Dict],
+               callback: Callable[[Optional[str]], None]) -> bool:
+        """
+        Queue a summarization, `callback` is called from the worker thread.
+
+        Returns:
+            bool. False if the queue was full, `callback` is never called then.
+        """
+        try:
+            self.queue.put_nowait((summary, turns, callback))
+            return True
+        except queue.Full:
+            self._count('dropped')
+            return False
+
+    def _work(self):
+        while True:
+            summary, turns, callback = self.queue.get()
+            result = None
+            # pylint: disable=broad-exception-caught
+            try:
+                result = self.summarize(summary, turns)
+            except Exception:
+                logger.exception('Summarization failed.')
+            self._count('summarized' if result is not None else 'failed')
+            try:
+                callback(result)
+            except Exception:
+                logger.exception('Summarization callback failed.')
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Wait until every queued job is done.
+        """
+        self.queue.join()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict:
+        """
+        Queue depth and job counters.
+        """
+        with self._lock:
+            return {'queue_depth': self.queue.qsize(), **self._counters}
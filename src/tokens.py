@@ -0,0 +1,70 @@
+"""
+tokens.py
+"""
+
+import functools
+import re
+from typing import Dict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Tokens the chat format adds around every message.
+MESSAGE_OVERHEAD = 4
+
+_WIDE_CHARS = re.compile(
+    r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef]')
+
+
+@functools.lru_cache(maxsize=8)
+def _encoding(model_engine: str):
+    try:
+        return tiktoken.encoding_for_model(model_engine)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: str, model_engine: str = None) -> int:
+    """
+    Count the tokens of a text for a model engine.
+
+    Uses tiktoken when it is installed, otherwise estimates one token per
+    CJK character and one per four other characters.
+
+    Params:
+        text: str. The text to count.
+        model_engine: str. The model engine the text is sent to.
+
+    Returns:
+        int. The number of tokens.
+    """
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding(model_engine or 'gpt-3.5-turbo').encode(text))
+    wide = len(_WIDE_CHARS.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def parse_token_budgets(value: str) -> Dict[str, int]:
+    """
+    Parse budgets written as `engine=tokens,engine=tokens`.
+
+    A bare number, or the engine `*`, sets the budget of every other engine.
+
+    Params:
+        value: str. The budgets, e.g. `gpt-3.5-turbo=3000,gpt-4=6000`.
+
+    Returns:
+        Dict mapping model engines (or `*`) to token budgets.
+    """
+    budgets = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        engine, _, budget = item.rpartition('=')
+        budgets[engine.strip() or '*'] = int(budget)
+    return budgets
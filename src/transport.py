@@ -0,0 +1,162 @@
+"""
+transport.py
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class HTTPTransport:
+    """
+    A keep-alive, connection-pooled HTTP client shared between threads.
+
+    Requests that fail with a connection error, a timeout or one of
+    `RETRY_STATUS_CODES` are retried with jittered exponential backoff
+    as long as the retry budget allows it.
+    """
+
+    def __init__(self,
+                 pool_size: int = 10,
+                 connect_timeout: float = 5,
+                 read_timeout: float = 60,
+                 max_retries: int = 3,
+                 backoff_base: float = 0.5,
+                 backoff_max: float = 8,
+                 retry_budget: float = 30):
+        """
+        Initialize the HTTPTransport instance.
+
+        Params:
+            pool_size: int. Max keep-alive connections per host.
+            connect_timeout: float. Seconds to wait for a connection.
+            read_timeout: float. Seconds to wait between bytes of the response.
+            max_retries: int. Retries after the first attempt.
+            backoff_base: float. First backoff in seconds, doubled on every retry.
+            backoff_max: float. Upper bound of a single backoff.
+            retry_budget: float. Total seconds a request may spend retrying.
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._lock = threading.Lock()
+        self._counters = {
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+        }
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a request, retrying transient failures.
+
+        Params:
+            method: str. The HTTP method.
+            url: str. The full url.
+            **kwargs: Passed to `requests.Session.request`.
+
+        Returns:
+            requests.Response. The last response received.
+
+        Raises:
+            requests.RequestException if the last attempt failed without a response.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        # Uploaded file objects are consumed by the first attempt.
+        retryable = not kwargs.get('files')
+        deadline = time.monotonic() + self.retry_budget
+        self._count('requests')
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self._backoff(attempt)
+                if not retryable or not self._can_retry(attempt, delay, deadline):
+                    self._count('failures')
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                delay = self._retry_after(response) or self._backoff(attempt)
+                if not retryable or not self._can_retry(attempt, delay, deadline):
+                    self._count('failures')
+                    return response
+                response.close()
+
+            attempt += 1
+            self._count('retries')
+            logger.warning('Retrying %s %s in %.2fs (attempt %d).', method, url, delay, attempt)
+            time.sleep(delay)
+
+    def _can_retry(self, attempt: int, delay: float, deadline: float) -> bool:
+        return attempt < self.max_retries and time.monotonic() + delay < deadline
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter keeps retrying clients from hitting the API in lockstep.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _retry_after(self, response: requests.Response) -> float:
+        try:
+            return min(float(response.headers.get('Retry-After')), self.backoff_max)
+        except (TypeError, ValueError):
+            return 0
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict:
+        """
+        Request/retry counters and connection pool usage.
+        """
+        pools = self.adapter.poolmanager.pools
+        opened, idle = 0, 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'pools': len(pools),
+                'connections_opened': opened,
+                'connections_idle': idle,
+                **self._counters
+            }
+
+
+_shared_transport = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_transport() -> HTTPTransport:
+    """
+    The process-wide transport used when no transport is given explicitly.
+    """
+    global _shared_transport  # pylint: disable=global-statement
+    with _shared_lock:
+        if _shared_transport is None:
+            _shared_transport = HTTPTransport()
+        return _shared_transport
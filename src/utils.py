@@ -1,11 +1,75 @@
-import opencc
+import functools
+import re
+from typing import Iterable, Iterator
 
-s2t_converter = opencc.OpenCC('s2t')
-t2s_converter = opencc.OpenCC('t2s')
+from src.converter import S2TConverter
+from src.metrics import metrics
+
+# Text messages longer than this are rejected by the LINE messaging API.
+LINE_MESSAGE_MAX_LENGTH = 5000
+
+_SENTENCE = re.compile(r'.*?(?:[。！？!?]+[」』）)"\']*|\.(?=\s)|\n+)', re.S)
+
+
+@functools.lru_cache(maxsize=None)
+def get_s2t_converter() -> S2TConverter:
+    """
+    The shared converter, built on first use as loading its dictionaries takes a while.
+    """
+    return S2TConverter()
+
+
+@metrics.timed('opencc')
+def to_traditional(text: str) -> str:
+    return get_s2t_converter().convert(text)
 
 
 def get_role_and_content(response: str):
     role = response['choices'][0]['message']['role']
     content = response['choices'][0]['message']['content'].strip()
-    content = s2t_converter.convert(content)
+    content = to_traditional(content)
     return role, content
+
+
+def split_sentences(deltas: Iterable[str]) -> Iterator[str]:
+    """
+    Re-chunk streamed text deltas into sentences as soon as each one ends.
+    Whitespace between sentences stays attached to the next sentence.
+    """
+    buffer = ''
+    for delta in deltas:
+        buffer += delta
+        position = 0
+        while True:
+            match = _SENTENCE.match(buffer, position)
+            if match is None:
+                break
+            position = match.end()
+            if buffer[:position].strip():
+                yield buffer[:position]
+                buffer, position = buffer[position:], 0
+    if buffer:
+        yield buffer
+
+
+def group_messages(sentences: Iterable[str], chunk_size: int = 300,
+                   max_length: int = LINE_MESSAGE_MAX_LENGTH) -> Iterator[str]:
+    """
+    Yield the first sentence on its own, then the following sentences
+    grouped into messages of about `chunk_size` characters.
+    No message is longer than `max_length`.
+    """
+    first, group = True, ''
+    for sentence in sentences:
+        for start in range(0, len(sentence), max_length):
+            piece = sentence[start:start + max_length]
+            if first and piece.strip():
+                first = False
+                yield piece
+                continue
+            if group and len(group) + len(piece) > min(chunk_size, max_length):
+                yield group
+                group = ''
+            group += piece
+    if group:
+        yield group
@@ -0,0 +1,52 @@
+"""
+webhook.py
+"""
+
+import inspect
+import logging
+
+from linebot import WebhookHandler as LineWebhookHandler
+from linebot.models import MessageEvent
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookHandler(LineWebhookHandler):
+    """
+    `linebot.WebhookHandler` that can also dispatch a payload parsed
+    beforehand, so a webhook verified on the request thread is not verified
+    again on the thread handling its events.
+    """
+
+    def handle(self, body, signature):
+        """
+        Verify and parse the webhook body, then call the handlers of its events.
+
+        Raises:
+            InvalidSignatureError: The signature does not match the body.
+        """
+        self.dispatch(self.parser.parse(body, signature, as_payload=True))
+
+    def dispatch(self, payload):
+        """
+        Call the handler of every event of a parsed payload, the same way
+        `linebot.WebhookHandler.handle` does.
+        """
+        for event in payload.events:
+            func = None
+            key = type(event).__name__
+            if isinstance(event, MessageEvent):
+                func = self._handlers.get(f'{key}_{type(event.message).__name__}')
+            if func is None:
+                func = self._handlers.get(key, self._default)
+            if func is None:
+                logger.info('No handler of %s and no default handler', key)
+                continue
+
+            spec = inspect.getfullargspec(func)
+            if spec.varargs is not None or len(spec.args) == 2:
+                func(event, payload.destination)
+            elif len(spec.args) == 1:
+                func(event)
+            else:
+                func()
@@ -0,0 +1,61 @@
+// Server-side paging of the logs table through /api/logs.
+// The API pages with opaque cursors, so only previous/next paging is offered
+// and the cursor of every visited page is kept to be able to go back.
+$(document).ready(function() {
+  var cursors = [null];
+
+  function escapeHtml(text) {
+    return $('<div>').text(text == null ? '' : text).html();
+  }
+
+  function toTimestamp(value) {
+    return value ? Math.floor(new Date(value).getTime() / 1000) : '';
+  }
+
+  var table = $('#dataTable').DataTable({
+    "serverSide": true,
+    "processing": true,
+    "searching": false,
+    "ordering": false,
+    "lengthChange": false,
+    "pageLength": 20,
+    "pagingType": "simple",
+    "ajax": function(data, callback) {
+      var page = Math.floor(data.start / data.length);
+      var form = $('#logFilter');
+      var params = {
+        "limit": data.length,
+        "user_id": form.find('[name=user_id]').val(),
+        "from": toTimestamp(form.find('[name=from]').val()),
+        "to": toTimestamp(form.find('[name=to]').val())
+      };
+      if (cursors[page]) {
+        params.cursor = cursors[page];
+      }
+      $.getJSON('api/logs', params, function(result) {
+        cursors[page + 1] = result.next_cursor;
+        // One extra row is enough for DataTables to enable the next button.
+        var total = data.start + result.data.length + (result.next_cursor ? 1 : 0);
+        callback({
+          "draw": data.draw,
+          "recordsTotal": total,
+          "recordsFiltered": total,
+          "data": result.data
+        });
+      });
+    },
+    "columns": [
+      {"data": "time"},
+      {"data": "user_id", "render": escapeHtml},
+      {"data": "prompt", "render": escapeHtml},
+      {"data": "input_text", "render": escapeHtml},
+      {"data": "output_text", "render": escapeHtml}
+    ]
+  });
+
+  $('#logFilter').on('submit', function(e) {
+    e.preventDefault();
+    cursors = [null];
+    table.page(0).draw('page');
+  });
+});
@@ -0,0 +1,25 @@
+"""
+conftest.py
+"""
+
+import pytest
+
+
+class FakeClock:
+    """
+    A clock moved by hand, for code that reads `time.monotonic` or `time.time`.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,111 @@
+"""
+test_coalesce.py
+"""
+
+import threading
+import time
+
+from src.coalesce import TurnCoalescer
+
+
+class Recorder:
+    """
+    A `process` recording the turns, blocked until `release` is set.
+    """
+
+    def __init__(self, blocked=False):
+        self.turns = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not blocked:
+            self.release.set()
+
+    def __call__(self, user_id, items):
+        self.turns.append((user_id, list(items)))
+        self.started.set()
+        self.release.wait(5)
+
+
+def submit_in_thread(coalescer, user_id, item):
+    thread = threading.Thread(target=coalescer.submit, args=(user_id, item))
+    thread.start()
+    return thread
+
+
+def test_messages_during_a_turn_are_answered_by_one_follow_up():
+    process = Recorder(blocked=True)
+    coalescer = TurnCoalescer(process)
+    thread = submit_in_thread(coalescer, 'u', 'a')
+    assert process.started.wait(5)
+
+    assert coalescer.submit('u', 'b') is False
+    assert coalescer.submit('u', 'c') is False
+    process.release.set()
+    thread.join(5)
+
+    assert process.turns == [('u', ['a']), ('u', ['b', 'c'])]
+    assert coalescer.stats() == {'active_users': 0, 'turns': 2, 'coalesced': 2}
+
+
+def test_users_do_not_wait_for_each_other():
+    process = Recorder(blocked=True)
+    coalescer = TurnCoalescer(process)
+    thread = submit_in_thread(coalescer, 'u', 'a')
+    assert process.started.wait(5)
+    process.started.clear()
+
+    other = submit_in_thread(coalescer, 'v', 'x')
+
+    assert process.started.wait(5)
+    assert ('v', ['x']) in process.turns
+    process.release.set()
+    thread.join(5)
+    other.join(5)
+
+
+def test_debounce_merges_messages_sent_in_quick_succession():
+    process = Recorder()
+    coalescer = TurnCoalescer(process, window=0.2)
+    thread = submit_in_thread(coalescer, 'u', 'a')
+
+    time.sleep(0.05)
+    assert coalescer.submit('u', 'b') is False
+    time.sleep(0.05)
+    assert coalescer.submit('u', 'c') is False
+    thread.join(5)
+
+    assert process.turns == [('u', ['a', 'b', 'c'])]
+
+
+def test_debounce_waits_at_most_max_wait():
+    process = Recorder()
+    coalescer = TurnCoalescer(process, window=0.2, max_wait=0.3)
+    started = time.monotonic()
+    thread = submit_in_thread(coalescer, 'u', 0)
+
+    # The user never stops typing for a whole window.
+    for i in range(1, 10):
+        time.sleep(0.1)
+        coalescer.submit('u', i)
+        if process.turns:
+            break
+
+    assert process.turns
+    assert time.monotonic() - started < 0.6
+    thread.join(5)
+    assert sorted(item for _, items in process.turns for item in items) == list(range(i + 1))
+
+
+def test_a_failing_turn_does_not_block_the_user():
+    calls = []
+
+    def process(user_id, items):
+        calls.append(items)
+        raise RuntimeError('OpenAI is down')
+
+    coalescer = TurnCoalescer(process)
+
+    assert coalescer.submit('u', 'a') is True
+    assert coalescer.submit('u', 'b') is True
+    assert calls == [['a'], ['b']]
+    assert coalescer.stats()['active_users'] == 0
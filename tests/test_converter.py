@@ -0,0 +1,73 @@
+"""
+test_converter.py
+"""
+
+import random
+
+import pytest
+
+from src.converter import S2TConverter
+
+opencc = pytest.importorskip('opencc')
+
+SAMPLE = (
+    '听起来你今天真的很累，辛苦了。工作上的压力有时候会让人喘不过气，'
+    '这种感觉是很正常的，不代表你不够好。\n\n'
+    '如果愿意的话，可以跟我说说今天发生了什么事吗？是不是有哪件事情让你特别在意？'
+    '有时候把心里的话说出来，会觉得轻松一点。\n\n'
+    '另外，也记得给自己一点休息的时间：喝杯温水、听听喜欢的音乐，或是早点睡觉。'
+    '你已经很努力了，对自己温柔一点也没关系。我会一直在这里陪你。'
+)
+
+
+def make_corpus(converter, count=5000, seed=0):
+    """
+    Texts mixing dictionary phrases, random CJK characters and punctuation,
+    so overlapping and adjacent phrases are converted too.
+    """
+    rng = random.Random(seed)
+    phrases = sorted(converter.phrases)
+    chars = [chr(code) for code in range(0x4e00, 0x9fa6)]
+    separators = ['，', '。', ' ', '!', '？', '\n', '…', 'OK', '「', '」']
+    corpus = [SAMPLE]
+    for _ in range(count):
+        parts = []
+        for _ in range(rng.randint(1, 12)):
+            roll = rng.random()
+            if roll < 0.4:
+                parts.append(rng.choice(phrases))
+            elif roll < 0.8:
+                parts.append(''.join(rng.choices(chars, k=rng.randint(1, 4))))
+            else:
+                parts.append(rng.choice(separators))
+        corpus.append(''.join(parts))
+    return corpus
+
+
+@pytest.fixture(scope='module')
+def reference():
+    return opencc.OpenCC('s2t')
+
+
+@pytest.mark.parametrize('cache_size', [4096, 0])
+def test_converter_matches_opencc(reference, cache_size):
+    converter = S2TConverter(cache_size=cache_size)
+
+    mismatches = [text for text in make_corpus(converter)
+                  if converter.convert(text) != reference.convert(text)]
+
+    assert mismatches == []
+
+
+def test_converter_keeps_text_without_simplified_chinese(reference):
+    converter = S2TConverter()
+
+    for text in ('', 'I hear you, that sounds exhausting.', '繁體中文不變。', '😀\n'):
+        assert converter.convert(text) == reference.convert(text) == text
+
+
+def test_cached_conversions_match(reference):
+    converter = S2TConverter(cache_size=1)
+
+    for text in (SAMPLE, SAMPLE, '头发', SAMPLE):
+        assert converter.convert(text) == reference.convert(text)
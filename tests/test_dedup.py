@@ -0,0 +1,115 @@
+"""
+test_dedup.py
+"""
+
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from src.dedup import EventDeduplicator, MemorySeenStore, MongoSeenStore
+
+mongomock = pytest.importorskip('mongomock')
+
+
+def expire_mongo_ids(store):
+    store.collection.update_many(
+        {}, {'$set': {'expire_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}})
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def store_and_expire(request, clock, monkeypatch):
+    """
+    A seen store, with a function making every id it holds expire.
+    """
+    if request.param == 'memory':
+        monkeypatch.setattr('src.cache.time.monotonic', clock)
+        return MemorySeenStore(), lambda store: clock.advance(61)
+    # The TTL monitor has not removed the expired ids yet.
+    return MongoSeenStore(mongomock.MongoClient().db), expire_mongo_ids
+
+
+def line_event(event_id):
+    return SimpleNamespace(webhook_event_id=event_id)
+
+
+def test_store_remembers_an_id_until_it_expires(store_and_expire):
+    store, expire = store_and_expire
+
+    assert store.add('e1', ttl=60)
+    assert not store.add('e1', ttl=60)
+    assert store.add('e2', ttl=60)
+    expire(store)
+    assert store.add('e1', ttl=60)
+    assert not store.add('e1', ttl=60)
+
+
+def test_store_forgets_a_discarded_id(store_and_expire):
+    store, _ = store_and_expire
+    store.add('e1', ttl=60)
+
+    store.discard('e1')
+
+    assert store.add('e1', ttl=60)
+
+
+def test_redelivered_events_are_handled_once(store_and_expire):
+    store, expire = store_and_expire
+    deduplicator = EventDeduplicator(store, ttl=60)
+    handled = []
+    handler = deduplicator.once(lambda event: handled.append(event.webhook_event_id))
+
+    for event_id in ('e1', 'e1', 'e2', 'e1'):
+        handler(line_event(event_id))
+
+    assert handled == ['e1', 'e2']
+    assert deduplicator.stats() == {'handled': 2, 'suppressed': 2, 'store_errors': 0}
+    expire(store)
+    handler(line_event('e1'))
+    assert handled == ['e1', 'e2', 'e1']
+
+
+def test_a_failed_event_is_handled_on_redelivery(store_and_expire):
+    store, _ = store_and_expire
+    deduplicator = EventDeduplicator(store)
+    calls = []
+
+    @deduplicator.once
+    def handler(event):
+        calls.append(event)
+        if len(calls) == 1:
+            raise RuntimeError('reply failed')
+
+    with pytest.raises(RuntimeError):
+        handler(line_event('e1'))
+    handler(line_event('e1'))
+    handler(line_event('e1'))
+
+    assert len(calls) == 2
+
+
+def test_events_without_an_id_are_always_handled():
+    deduplicator = EventDeduplicator(MemorySeenStore())
+    handled = []
+    handler = deduplicator.once(handled.append)
+
+    handler(SimpleNamespace())
+    handler(SimpleNamespace())
+
+    assert len(handled) == 2
+
+
+def test_events_are_handled_when_the_store_fails():
+    class BrokenStore(MemorySeenStore):
+        def add(self, key, ttl):
+            raise ConnectionError('MongoDB is down')
+
+    deduplicator = EventDeduplicator(BrokenStore())
+    handled = []
+    handler = deduplicator.once(handled.append)
+
+    handler(line_event('e1'))
+    handler(line_event('e1'))
+
+    assert len(handled) == 2
+    assert deduplicator.stats()['store_errors'] == 2
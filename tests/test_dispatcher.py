@@ -0,0 +1,96 @@
+"""
+test_dispatcher.py
+"""
+
+import threading
+import time
+
+from src.dispatcher import EventDispatcher
+
+
+def wait_for_busy_workers(dispatcher, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while dispatcher.stats()['busy_workers'] < count:
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_jobs_run_on_the_workers():
+    dispatcher = EventDispatcher(workers=2)
+    dispatcher.start()
+    done = []
+
+    for i in range(10):
+        assert dispatcher.submit(done.append, i)
+    dispatcher.shutdown(timeout=5)
+
+    assert sorted(done) == list(range(10))
+    assert dispatcher.stats()['processed'] == 10
+
+
+def test_a_full_queue_sheds_jobs():
+    dispatcher = EventDispatcher(workers=1, max_queue_size=2)
+    release = threading.Event()
+    dispatcher.start()
+    dispatcher.submit(release.wait, 5)
+    # The worker is busy, two jobs fill the queue.
+    wait_for_busy_workers(dispatcher, 1)
+    assert dispatcher.submit(time.sleep, 0)
+    assert dispatcher.submit(time.sleep, 0)
+
+    assert not dispatcher.submit(time.sleep, 0)
+    assert dispatcher.stats()['dropped'] == 1
+    release.set()
+    dispatcher.shutdown(timeout=5)
+
+
+def test_submit_waits_for_a_free_slot_up_to_the_put_timeout():
+    dispatcher = EventDispatcher(workers=1, max_queue_size=1, put_timeout=0.05)
+    dispatcher.submit(time.sleep, 0)
+
+    started = time.monotonic()
+    assert not dispatcher.submit(time.sleep, 0)
+    assert time.monotonic() - started >= 0.05
+
+
+def test_failing_jobs_do_not_stop_the_workers():
+    dispatcher = EventDispatcher(workers=1)
+    dispatcher.start()
+    done = []
+
+    dispatcher.submit(lambda: 1 / 0)
+    dispatcher.submit(done.append, 'after')
+    dispatcher.shutdown(timeout=5)
+
+    assert done == ['after']
+    assert dispatcher.stats()['failed'] == 1
+
+
+def test_shutdown_finishes_the_queued_jobs():
+    dispatcher = EventDispatcher(workers=2)
+    dispatcher.start()
+    done = []
+
+    for i in range(4):
+        dispatcher.submit(lambda i=i: (time.sleep(0.05), done.append(i)))
+    dispatcher.shutdown(timeout=5)
+
+    assert sorted(done) == [0, 1, 2, 3]
+    assert dispatcher.stats()['workers'] == 0
+
+
+def test_shutdown_gives_up_at_the_timeout():
+    dispatcher = EventDispatcher(workers=2, max_queue_size=1)
+    release = threading.Event()
+    dispatcher.start()
+    for busy in (1, 2):
+        dispatcher.submit(release.wait, 5)
+        wait_for_busy_workers(dispatcher, busy)
+    dispatcher.submit(time.sleep, 0)
+
+    started = time.monotonic()
+    # The queue is full and the workers are stuck, the timeout bounds the whole shutdown.
+    dispatcher.shutdown(timeout=0.2)
+
+    assert time.monotonic() - started < 1
+    release.set()
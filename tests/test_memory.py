@@ -0,0 +1,217 @@
+"""
+test_memory.py
+"""
+
+import datetime
+import os
+import time
+
+import pytest
+
+from src.memory import Memory, MongoMemory
+from src.snapshot import encode_record, write_snapshot
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def mongo_memory():
+    return MongoMemory(
+        mongomock.MongoClient().db, system_message='sys',
+        memory_message_count=1, ttl=60, cache_ttl=0)
+
+
+def test_mongo_append_keeps_the_window(mongo_memory):
+    for role, content in (('user', 'a'), ('assistant', 'b'), ('user', 'c'), ('assistant', 'd')):
+        mongo_memory.append('u', role, content)
+
+    assert mongo_memory.get('u') == [
+        {'role': 'system', 'content': 'sys'},
+        {'role': 'assistant', 'content': 'b'},
+        {'role': 'user', 'content': 'c'},
+        {'role': 'assistant', 'content': 'd'},
+    ]
+
+
+def test_mongo_append_stores_content_as_is(mongo_memory):
+    mongo_memory.append('u', 'user', '$messages')
+
+    assert mongo_memory.get('u')[-1] == {'role': 'user', 'content': '$messages'}
+
+
+def test_mongo_append_starts_an_expired_conversation_over(mongo_memory):
+    mongo_memory.change_system_message('u', 'custom')
+    mongo_memory.append('u', 'user', 'old')
+    # Past its expiry, the TTL monitor has not removed it yet.
+    mongo_memory.collection.update_one(
+        {'user_id': 'u'},
+        {'$set': {'expire_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}})
+
+    mongo_memory.append('u', 'user', 'new')
+
+    assert mongo_memory.get('u') == [
+        {'role': 'system', 'content': 'sys'},
+        {'role': 'user', 'content': 'new'},
+    ]
+    document = mongo_memory.collection.find_one({'user_id': 'u'})
+    assert document['expire_at'] > datetime.datetime.utcnow()
+
+
+def test_mongo_load_skips_an_expired_conversation(mongo_memory):
+    mongo_memory.append('u', 'user', 'old')
+    mongo_memory.collection.update_one(
+        {'user_id': 'u'},
+        {'$set': {'expire_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}})
+
+    assert mongo_memory.get('u') == []
+
+
+def test_mongo_cache_serves_recent_appends():
+    memory = MongoMemory(
+        mongomock.MongoClient().db, system_message='sys',
+        memory_message_count=1, cache_ttl=60)
+    memory.append('u', 'user', 'a')
+    memory.get('u')
+
+    assert memory.stats()['cache_hits'] == 1
+    assert memory.stats()['cache_misses'] == 0
+
+
+def test_memory_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'memory.snapshot')
+    memory = Memory('sys', 1, snapshot_path=path, snapshot_interval=0)
+    memory.append('u', 'user', '你好')
+    memory.close()
+
+    restored = Memory('sys', 1, snapshot_path=path, snapshot_interval=0)
+
+    assert restored.get('u') == [{'role': 'system', 'content': 'sys'}, {'role': 'user', 'content': '你好'}]
+    restored.close()
+    assert os.listdir(tmp_path) == ['memory.snapshot']
+
+
+def test_memory_drops_a_truncated_snapshot(tmp_path):
+    path = str(tmp_path / 'memory.snapshot')
+    memory = Memory('sys', 1, snapshot_path=path, snapshot_interval=0)
+    for i in range(10):
+        memory.append(f'u{i}', 'user', f'message {i}')
+    memory.close()
+    with open(path, 'r+b') as file:
+        file.truncate(os.path.getsize(path) // 2)
+
+    memory = Memory('sys', 1, snapshot_path=path, snapshot_interval=0)
+    memory.append('new', 'user', 'hi')
+
+    assert memory.get('u9') == []
+    assert memory.get('new')[-1] == {'role': 'user', 'content': 'hi'}
+    memory.remove('u0')
+    memory.close()
+    assert Memory('sys', 1, snapshot_path=path, snapshot_interval=0).get('new')[-1]['content'] == 'hi'
+
+
+def test_memory_skips_a_corrupt_snapshot_record(tmp_path):
+    path = str(tmp_path / 'memory.snapshot')
+    records = [encode_record('bad', time.time(), None, [('user', 'x', None)], None),
+               encode_record('good', time.time(), None, [('user', 'y', None)], None)]
+    records[0] = records[0].replace(b'"t"', b'"?"')
+    write_snapshot(path, records)
+
+    memory = Memory('sys', 1, snapshot_path=path, snapshot_interval=0)
+
+    assert memory.get('bad') == []
+    assert memory.get('good')[-1] == {'role': 'user', 'content': 'y'}
+
+
+@pytest.fixture
+def clock(clock, monkeypatch):  # pylint: disable=redefined-outer-name
+    monkeypatch.setattr('src.memory.time.monotonic', clock)
+    return clock
+
+
+def test_memory_keeps_a_strict_window():
+    memory = Memory('sys', 1)
+
+    for content in ('a', 'b', 'c', 'd', 'e'):
+        memory.append('u', 'user', content)
+
+    # The latest pair plus the message being answered.
+    assert [message['content'] for message in memory.get('u')] == ['sys', 'c', 'd', 'e']
+
+
+def test_memory_evicts_the_least_recently_used_user():
+    memory = Memory('sys', 1, max_users=2)
+    memory.append('a', 'user', 'hi')
+    memory.append('b', 'user', 'hi')
+    # Reading counts as a use, `b` is now the least recently used.
+    memory.get('a')
+
+    memory.append('c', 'user', 'hi')
+
+    assert list(memory.conversations) == ['a', 'c']
+    assert memory.get('b') == []
+
+
+def test_memory_expires_idle_users(clock):
+    memory = Memory('sys', 1, ttl=10)
+    memory.append('a', 'user', 'old')
+    clock.advance(5)
+    memory.append('b', 'user', 'hi')
+    clock.advance(6)
+
+    assert memory.get('a') == []
+    assert memory.get('b')[-1]['content'] == 'hi'
+    memory.append('a', 'user', 'new')
+    assert [message['content'] for message in memory.get('a')] == ['sys', 'new']
+
+
+@pytest.fixture
+def one_token_per_char(monkeypatch):
+    monkeypatch.setattr('src.memory.count_tokens', lambda text, model_engine=None: len(text))
+
+
+def budget_memory(budgets):
+    memory = Memory('sys', 3, token_budgets=budgets)
+    for content in ('first', 'second', 'third', 'fourth'):
+        memory.append('u', 'user', content)
+    return memory
+
+
+def test_memory_drops_the_oldest_turns_over_the_budget(one_token_per_char):
+    # sys and every turn cost MESSAGE_OVERHEAD (4) more than their length.
+    memory = budget_memory({'gpt-x': 7 + 10 + 9})
+
+    assert [message['content'] for message in memory.get('u', 'gpt-x')] == ['sys', 'third', 'fourth']
+    assert len(memory.get('u')) == 5
+    assert len(memory.get('u', 'gpt-other')) == 5
+
+
+def test_memory_budget_keeps_the_latest_turn(one_token_per_char):
+    memory = budget_memory({'*': 1})
+
+    assert [message['content'] for message in memory.get('u', 'gpt-x')] == ['sys', 'fourth']
+
+
+def test_memory_budget_counts_the_summary(one_token_per_char):
+    memory = budget_memory({'gpt-x': 7 + 10 + 9})
+    memory.conversations['u'].summary = 'x'
+
+    assert [message['content'] for message in memory.get('u', 'gpt-x')][-1:] == ['fourth']
+    assert len(memory.get('u', 'gpt-x')) == 3
+
+
+def test_memory_count_skips_expired_users(clock):
+    memory = Memory('sys', 1, ttl=10)
+    memory.append('a', 'user', 'hi')
+    clock.advance(5)
+    memory.append('b', 'user', 'hi')
+
+    assert memory.count() == 2
+    clock.advance(6)
+    assert memory.count() == 1
+
+
+def test_mongo_count(mongo_memory):
+    mongo_memory.append('a', 'user', 'hi')
+    mongo_memory.append('b', 'user', 'hi')
+
+    assert mongo_memory.count() == 2
@@ -0,0 +1,420 @@
+"""
+test_models.py
+"""
+
+import json
+import time
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from src.metrics import Metrics
+from src.models import DynamoDBLogHandler, OpenAIModel, encode_cursor
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+
+class FakeStreamResponse:
+    """
+    A streamed response carrying server-sent event lines.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.encoding = None
+        self.closed = False
+
+    def iter_lines(self, decode_unicode=False):  # pylint: disable=unused-argument
+        yield from self.lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+
+
+def sse(chunk):
+    return 'data: ' + json.dumps(chunk, ensure_ascii=False)
+
+
+def test_iter_stream_yields_content_deltas(monkeypatch):
+    response = FakeStreamResponse([
+        sse({'choices': [{'delta': {'role': 'assistant'}}]}),
+        '',
+        ': keep-alive',
+        sse({'choices': [{'delta': {'content': '你好'}}]}),
+        sse({'choices': [{'delta': {'content': '。'}}]}),
+        sse({'choices': [], 'usage': {'prompt_tokens': 3, 'completion_tokens': 2}}),
+        'data: [DONE]',
+        sse({'choices': [{'delta': {'content': 'after done'}}]}),
+    ])
+    metrics = Metrics(enabled=True)
+    monkeypatch.setattr('src.models.metrics', metrics)
+
+    # pylint: disable=protected-access
+    assert list(OpenAIModel._iter_stream(response)) == ['你好', '。']
+    assert response.encoding == 'utf-8'
+    assert response.closed
+    assert 'chatbot_openai_tokens_total{type="prompt"} 3' in metrics.render()
+
+
+def test_iter_stream_of_an_empty_completion():
+    response = FakeStreamResponse([sse({'choices': [{'delta': {'role': 'assistant'}}]}), 'data: [DONE]'])
+
+    assert list(OpenAIModel._iter_stream(response)) == []  # pylint: disable=protected-access
+
+
+def test_iter_stream_raises_on_an_error_event():
+    response = FakeStreamResponse([
+        sse({'choices': [{'delta': {'content': '你'}}]}),
+        sse({'error': {'message': 'That model is currently overloaded with other requests.'}}),
+    ])
+    deltas = OpenAIModel._iter_stream(response)  # pylint: disable=protected-access
+
+    assert next(deltas) == '你'
+    with pytest.raises(RuntimeError, match='overloaded'):
+        next(deltas)
+    assert response.closed
+
+
+class FakeTransport:
+    """
+    An `HTTPTransport` answering every request with `response`.
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def request(self, method, url, **kwargs):  # pylint: disable=unused-argument
+        return self.response
+
+
+def stream_model(lines, status_code=200):
+    response = FakeStreamResponse(lines)
+    response.status_code = status_code
+    response.reason = 'Too Many Requests'
+    response.json = lambda: {'error': {'message': 'Rate limit reached'}}
+    return OpenAIModel('sk-test', transport=FakeTransport(response))
+
+
+def test_stream_is_in_flight_until_exhausted():
+    model = stream_model([sse({'choices': [{'delta': {'content': c}}]}) for c in '你好'] + ['data: [DONE]'])
+
+    is_successful, deltas, _ = model.chat_completions_stream([], 'gpt-x')
+
+    assert is_successful
+    assert model.in_flight == 1
+    assert next(deltas) == '你'
+    assert model.in_flight == 1
+    assert list(deltas) == ['好']
+    assert model.in_flight == 0
+
+
+def test_closed_stream_is_no_longer_in_flight():
+    model = stream_model([sse({'choices': [{'delta': {'content': c}}]}) for c in '你好'])
+    _, deltas, _ = model.chat_completions_stream([], 'gpt-x')
+
+    next(deltas)
+    deltas.close()
+
+    assert model.in_flight == 0
+
+
+def test_failed_stream_is_not_in_flight():
+    model = stream_model([], status_code=429)
+
+    assert model.chat_completions_stream([], 'gpt-x') == (False, None, 'Rate limit reached')
+    assert model.in_flight == 0
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-west-1')
+    with moto.mock_aws():
+        resource = boto3.resource('dynamodb')
+        resource.create_table(
+            TableName=DynamoDBLogHandler.TABLE_NAME,
+            KeySchema=[
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'user_id', 'AttributeType': 'S'},
+                {'AttributeName': 'timestamp', 'AttributeType': 'N'}],
+            BillingMode='PAY_PER_REQUEST')
+        yield resource
+
+
+class FlakyResource:
+    """
+    A DynamoDB resource whose next BatchWriteItem calls fail as scripted:
+    an exception is raised, 'unprocessed' leaves the last item unprocessed.
+    """
+
+    def __init__(self, resource, failures=()):
+        self.resource = resource
+        self.failures = list(failures)
+        self.calls = []
+
+    def Table(self, name):  # pylint: disable=invalid-name
+        return self.resource.Table(name)
+
+    def batch_write_item(self, RequestItems):  # pylint: disable=invalid-name
+        self.calls.append(RequestItems)
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, Exception):
+            raise failure
+        if failure == 'unprocessed':
+            (table_name, requests), = RequestItems.items()
+            self.resource.batch_write_item(RequestItems={table_name: requests[:-1]})
+            return {'UnprocessedItems': {table_name: requests[-1:]}}
+        return self.resource.batch_write_item(RequestItems=RequestItems)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def rows(resource):
+    return resource.Table(DynamoDBLogHandler.TABLE_NAME).scan()['Items']
+
+
+def write_logs(db_logger, count, user_id='u', start=1700000000):
+    for i in range(count):
+        db_logger.write_log(start + i, user_id, 'prompt', f'in {i}', f'out {i}')
+
+
+def test_full_batch_is_written_before_the_interval(dynamodb):
+    flaky = FlakyResource(dynamodb)
+    db_logger = DynamoDBLogHandler(flaky, buffered=True, batch_size=5, flush_interval=60)
+
+    write_logs(db_logger, 5)
+
+    wait_for(lambda: db_logger.stats()['written'] == 5)
+    assert len(flaky.calls) == 1
+    assert len(rows(dynamodb)) == 5
+    db_logger.close()
+
+
+def test_partial_batch_is_written_after_the_interval(dynamodb):
+    db_logger = DynamoDBLogHandler(dynamodb, buffered=True, batch_size=25, flush_interval=0.1)
+
+    write_logs(db_logger, 3)
+
+    wait_for(lambda: db_logger.stats()['written'] == 3)
+    assert db_logger.stats()['batches'] == 1
+    db_logger.close()
+
+
+def test_unprocessed_items_are_retried(dynamodb):
+    flaky = FlakyResource(dynamodb, ['unprocessed', 'unprocessed'])
+    db_logger = DynamoDBLogHandler(flaky, buffered=True, batch_size=3, flush_interval=60)
+
+    write_logs(db_logger, 3)
+
+    wait_for(lambda: db_logger.stats()['written'] == 3)
+    assert db_logger.stats()['retries'] == 2
+    assert db_logger.stats()['failed'] == 0
+    assert len(rows(dynamodb)) == 3
+    db_logger.close()
+
+
+def test_writer_survives_connection_errors(dynamodb):
+    flaky = FlakyResource(dynamodb, [EndpointConnectionError(endpoint_url='http://dynamodb')] * 10)
+    db_logger = DynamoDBLogHandler(
+        flaky, buffered=True, batch_size=2, flush_interval=60, max_retries=1)
+
+    write_logs(db_logger, 2)
+    wait_for(lambda: db_logger.stats()['failed'] == 2)
+    flaky.failures.clear()
+    write_logs(db_logger, 2, start=1700000100)
+
+    wait_for(lambda: db_logger.stats()['written'] == 2)
+    assert db_logger.stats()['buffered'] == 0
+    db_logger.close()
+
+
+def test_duplicate_keys_in_a_batch_keep_the_last_item(dynamodb):
+    db_logger = DynamoDBLogHandler(dynamodb, buffered=True, batch_size=4, flush_interval=60)
+
+    db_logger.write_log(1700000000, 'u', 'prompt', 'first', 'first')
+    db_logger.write_log(1700000000, 'u', 'prompt', 'second', 'second')
+    db_logger.write_log(1700000000, 'v', 'prompt', 'other', 'other')
+    db_logger.write_log(1700000001, 'u', 'prompt', 'later', 'later')
+
+    wait_for(lambda: db_logger.stats()['batches'] == 1)
+    assert db_logger.stats()['failed'] == 0
+    items = {(item['user_id'], int(item['timestamp'])): item['input_text'] for item in rows(dynamodb)}
+    assert items == {('u', 1700000000): 'second', ('v', 1700000000): 'other',
+                     ('u', 1700000001): 'later'}
+    db_logger.close()
+
+
+def test_close_drains_the_buffer(dynamodb):
+    db_logger = DynamoDBLogHandler(dynamodb, buffered=True, batch_size=25, flush_interval=60)
+
+    write_logs(db_logger, 30)
+    db_logger.close(timeout=5)
+
+    assert len(rows(dynamodb)) == 30
+    assert db_logger.stats()['buffered'] == 0
+
+
+def test_close_does_not_hang_on_a_full_buffer(dynamodb):
+    db_logger = DynamoDBLogHandler(
+        dynamodb, buffered=True, batch_size=2, flush_interval=60, max_buffer_size=4)
+    # Stop the writer, the buffer then fills up.
+    db_logger._buffer.put(None)  # pylint: disable=protected-access
+    db_logger._writer.join(5)  # pylint: disable=protected-access
+    write_logs(db_logger, 4)
+    assert db_logger.stats()['buffered'] == 4
+
+    db_logger.close(timeout=1)
+
+    assert len(rows(dynamodb)) == 4
+    assert db_logger.stats()['buffered'] == 0
+
+
+def test_logs_are_scanned_until_the_indexes_exist(dynamodb):
+    db_logger = DynamoDBLogHandler(dynamodb)
+    write_logs(db_logger, 3)
+
+    assert len(db_logger.query_log(limit=10)) == 3
+    assert db_logger.query_log(user_id='u', limit=10)
+    assert not db_logger.indexes_ready()
+
+
+def test_logs_are_scanned_when_the_indexes_can_not_be_checked(dynamodb, monkeypatch):
+    db_logger = DynamoDBLogHandler(dynamodb)
+    write_logs(db_logger, 3)
+    monkeypatch.setattr(db_logger, 'indexes_ready', mock.Mock(
+        side_effect=EndpointConnectionError(endpoint_url='http://dynamodb')))
+
+    assert len(db_logger.query_log(limit=10)) == 3
+    db_logger.indexes_ready.assert_called_once()
+
+
+def test_migrate_backfills_and_creates_the_indexes(dynamodb):
+    from src import migrate  # pylint: disable=import-outside-toplevel
+
+    table = dynamodb.Table(DynamoDBLogHandler.TABLE_NAME)
+    # Written before logs had a day bucket.
+    table.put_item(Item={'timestamp': 1700000000, 'user_id': 'old', 'prompt': 'p',
+                         'input_text': 'i', 'output_text': 'o'})
+    DynamoDBLogHandler(dynamodb).write_log(1700000100, 'new', 'p', 'i', 'o')
+
+    migrate.main([])
+
+    db_logger = DynamoDBLogHandler(dynamodb)
+    assert db_logger.indexes_ready()
+    data = db_logger.query_log(from_timestamp=1699990000, to_timestamp=1700001000, limit=10)
+    assert [item['user_id'] for item in data] == ['new', 'old']
+    assert db_logger.query_log(user_id='old', limit=10)[0]['day'] == '2023-11-14'
+
+
+# Pages without a start only look back `lookback_days`.
+NOW = int(time.time()) - 100
+
+
+@pytest.fixture
+def indexed_logger(dynamodb):
+    db_logger = DynamoDBLogHandler(dynamodb, indexed=True, query_cache_ttl=60)
+    db_logger.create_indexes()
+    return db_logger
+
+
+def read_all_pages(db_logger, **filters):
+    data, cursor = db_logger.query_log_page(limit=2, **filters)
+    while cursor is not None:
+        page, cursor = db_logger.query_log_page(limit=2, cursor=cursor, **filters)
+        data.extend(page)
+    return [item['input_text'] for item in data]
+
+
+def test_new_logs_are_added_to_cached_first_pages(indexed_logger):
+    write_logs(indexed_logger, 3, start=NOW)
+    indexed_logger.query_log_page(limit=2)
+    indexed_logger.query_log_page(user_id='u', limit=2)
+    indexed_logger.query_log_page(user_id='v', limit=2)
+    misses = indexed_logger.query_cache.stats()['misses']
+
+    indexed_logger.write_log(NOW + 10, 'u', 'prompt', 'newest', 'out')
+
+    assert [item['input_text'] for item in indexed_logger.query_log_page(limit=2)[0]] == \
+        ['newest', 'in 2']
+    assert [item['input_text'] for item in indexed_logger.query_log_page(user_id='u', limit=2)[0]] == \
+        ['newest', 'in 2']
+    assert indexed_logger.query_log_page(user_id='v', limit=2)[0] == []
+    assert indexed_logger.query_cache.stats()['misses'] == misses
+
+
+def test_pages_after_a_patched_first_page_skip_no_log(indexed_logger):
+    write_logs(indexed_logger, 3, start=NOW)
+    assert read_all_pages(indexed_logger) == ['in 2', 'in 1', 'in 0']
+    assert read_all_pages(indexed_logger, user_id='u') == ['in 2', 'in 1', 'in 0']
+
+    indexed_logger.write_log(NOW + 10, 'u', 'prompt', 'newest', 'out')
+
+    assert read_all_pages(indexed_logger) == ['newest', 'in 2', 'in 1', 'in 0']
+    assert read_all_pages(indexed_logger, user_id='u') == ['newest', 'in 2', 'in 1', 'in 0']
+
+
+def test_scanned_logs_are_paged(dynamodb):
+    db_logger = DynamoDBLogHandler(dynamodb, indexed=False)
+    write_logs(db_logger, 7)
+    write_logs(db_logger, 3, user_id='v', start=1700000100)
+
+    pages = []
+    page, cursor = db_logger.query_log_page(limit=2)
+    pages.append(page)
+    while cursor is not None:
+        page, cursor = db_logger.query_log_page(limit=2, cursor=cursor)
+        pages.append(page)
+
+    assert all(len(page) <= 2 for page in pages)
+    assert all(page == sorted(page, key=lambda item: item['timestamp'], reverse=True) for page in pages)
+    assert sorted(item['input_text'] for page in pages for item in page) == \
+        sorted([f'in {i}' for i in range(7)] + [f'in {i}' for i in range(3)])
+    assert len(db_logger.query_log(user_id='v', limit=2)) == 2
+    assert sorted(read_all_pages(db_logger, user_id='v')) == ['in 0', 'in 1', 'in 2']
+
+
+def test_scanned_pages_are_dropped_from_the_cache_on_write(dynamodb):
+    db_logger = DynamoDBLogHandler(dynamodb, indexed=False, query_cache_ttl=60)
+    write_logs(db_logger, 3, start=NOW)
+    db_logger.query_log_page(limit=2)
+    db_logger.query_log_page(limit=10)
+
+    db_logger.write_log(NOW + 10, 'u', 'prompt', 'newest', 'out')
+
+    assert len(db_logger.query_cache) == 1
+    assert db_logger.query_log_page(limit=10)[0][0]['input_text'] == 'newest'
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_tampered_cursors_are_rejected(dynamodb, monkeypatch, indexed):
+    db_logger = DynamoDBLogHandler(dynamodb, indexed=indexed)
+    if indexed:
+        db_logger.create_indexes()
+    write_logs(db_logger, 3, start=NOW)
+
+    for cursor in ('not a cursor!', encode_cursor([1]), encode_cursor({'day': 5}),
+                   encode_cursor({'day': 'yesterday'}), encode_cursor({'key': 'x', 'scan': 'x'})):
+        with pytest.raises(ValueError):
+            db_logger.query_log_page(limit=2, cursor=cursor)
+
+    # DynamoDB rejects a start key that does not fit the table.
+    error = ClientError({'Error': {'Code': 'ValidationException', 'Message': 'invalid key'}}, 'Query')
+    monkeypatch.setattr(db_logger.table, 'query', mock.Mock(side_effect=error))
+    monkeypatch.setattr(db_logger.table, 'scan', mock.Mock(side_effect=error))
+    with pytest.raises(ValueError):
+        db_logger.query_log_page(limit=2, cursor=encode_cursor({'key': {'nope': 1}, 'scan': {'nope': 1}}))
+    with pytest.raises(ClientError):
+        db_logger.query_log_page(limit=2)
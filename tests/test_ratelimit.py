@@ -0,0 +1,68 @@
+"""
+test_ratelimit.py
+"""
+
+import pytest
+
+from src.ratelimit import MemoryLimiterStore, MongoLimiterStore, RateLimiter
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def store(request, clock):
+    if request.param == 'memory':
+        return MemoryLimiterStore(clock=clock)
+    return MongoLimiterStore(mongomock.MongoClient().db, clock=clock)
+
+
+def test_bucket_allows_a_burst_then_limits(store):
+    assert [store.take('k', rate=0.5, capacity=3) for _ in range(5)] == \
+        [True, True, True, False, False]
+
+
+def test_bucket_refills_at_the_rate(store, clock):
+    for _ in range(3):
+        store.take('k', rate=0.5, capacity=3)
+
+    clock.advance(1)
+    assert not store.take('k', rate=0.5, capacity=3)
+    clock.advance(1)
+    assert store.take('k', rate=0.5, capacity=3)
+    assert not store.take('k', rate=0.5, capacity=3)
+
+
+def test_bucket_does_not_refill_past_the_capacity(store, clock):
+    store.take('k', rate=1, capacity=2)
+    clock.advance(60)
+
+    assert [store.take('k', rate=1, capacity=2) for _ in range(3)] == [True, True, False]
+
+
+def test_buckets_are_separate(store):
+    assert store.take('a', rate=1, capacity=1)
+    assert store.take('b', rate=1, capacity=1)
+    assert not store.take('a', rate=1, capacity=1)
+
+
+def test_limiter_applies_the_user_bucket(store):
+    limiter = RateLimiter(store, user_rate=0.1, user_burst=2)
+
+    assert [limiter.allow('u') for _ in range(3)] == [True, True, False]
+    assert limiter.allow('v')
+    assert limiter.stats() == {'allowed': 3, 'limited_user': 1, 'limited_global': 0}
+
+
+def test_limiter_applies_the_global_bucket(store, clock):
+    limiter = RateLimiter(store, user_rate=1, user_burst=5, global_rate=1, global_burst=2)
+
+    assert [limiter.allow(user_id) for user_id in ('a', 'b', 'c')] == [True, True, False]
+    assert limiter.stats()['limited_global'] == 1
+    clock.advance(1)
+    assert limiter.allow('c')
+
+
+def test_limiter_without_rates_allows_everything(store):
+    limiter = RateLimiter(store)
+
+    assert all(limiter.allow('u') for _ in range(100))
@@ -0,0 +1,88 @@
+"""
+test_response_cache.py
+"""
+
+import datetime
+import time
+
+import pytest
+
+from src.response_cache import MemoryResponseStore, MongoResponseStore, ResponseCache, normalize
+
+mongomock = pytest.importorskip('mongomock')
+
+
+def prompt(content, system='sys'):
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': content}]
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def store(request):
+    if request.param == 'memory':
+        return MemoryResponseStore(ttl=60)
+    return MongoResponseStore(mongomock.MongoClient().db, ttl=60)
+
+
+def test_normalize_folds_width_case_whitespace_and_trailing_punctuation():
+    assert normalize('  Ｈｉ   THERE！！ ') == normalize('hi there') == 'hi there'
+    assert normalize('你好。') == '你好'
+
+
+def test_only_short_history_free_prompts_are_cacheable():
+    cache = ResponseCache(MemoryResponseStore(), max_prompt_length=5)
+
+    assert cache.key('gpt', prompt('你好')) is not None
+    assert cache.key('gpt', prompt('你好！')) == cache.key('gpt', prompt('你好'))
+    assert cache.key('gpt', prompt('這句話超過五個字')) is None
+    assert cache.key('gpt', prompt('。。。')) is None
+    assert cache.key('gpt', prompt('你好') + [{'role': 'assistant', 'content': '嗨'}]) is None
+    assert cache.key('gpt', [{'role': 'user', 'content': '你好'}]) is None
+
+
+def test_keys_depend_on_the_engine_and_the_system_message():
+    cache = ResponseCache(MemoryResponseStore())
+
+    assert cache.key('gpt-a', prompt('你好')) != cache.key('gpt-b', prompt('你好'))
+    assert cache.key('gpt', prompt('你好', 'sys a')) != cache.key('gpt', prompt('你好', 'sys b'))
+
+
+def test_a_stored_response_is_a_hit(store):
+    cache = ResponseCache(store)
+    key = cache.key('gpt', prompt('你好'))
+
+    assert cache.get(key) is None
+    cache.put(key, '嗨，今天過得如何？', latency=2.0)
+
+    assert cache.get(key) == '嗨，今天過得如何？'
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 0.5)
+    assert stats['latency_saved'] == 2.0
+
+
+def test_a_key_is_served_once_every_variant_is_collected(store):
+    cache = ResponseCache(store, variants=3)
+    key = cache.key('gpt', prompt('你好'))
+
+    for response in ('one', 'two'):
+        cache.put(key, response, latency=1.0)
+        assert cache.get(key) is None
+    cache.put(key, 'three', latency=1.0)
+    cache.put(key, 'four', latency=1.0)
+
+    assert {cache.get(key) for _ in range(50)} == {'two', 'three', 'four'}
+
+
+def test_expired_responses_are_misses(store, monkeypatch):
+    cache = ResponseCache(store)
+    key = cache.key('gpt', prompt('你好'))
+    cache.put(key, '嗨', latency=1.0)
+
+    if isinstance(store, MongoResponseStore):
+        # Past its expiry, the TTL monitor has not removed it yet.
+        store.collection.update_one(
+            {'_id': key}, {'$set': {'expire_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=1)}})
+    else:
+        later = time.monotonic() + 61
+        monkeypatch.setattr('src.cache.time.monotonic', lambda: later)
+
+    assert cache.get(key) is None
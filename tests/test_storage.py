@@ -0,0 +1,111 @@
+"""
+test_storage.py
+"""
+
+import json
+
+import pytest
+
+from src.storage import FileStorage, MongoStorage, Storage
+
+mongomock = pytest.importorskip('mongomock')
+
+
+def read_lines(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def test_file_storage_appends_one_line_per_save(tmp_path):
+    path = str(tmp_path / 'db.json')
+    storage = FileStorage(path)
+
+    storage.save({'a': 'key-a'})
+    storage.save({'b': 'key-b'})
+    storage.save({'a': 'key-a2'})
+
+    assert read_lines(path) == [{'a': 'key-a'}, {'b': 'key-b'}, {'a': 'key-a2'}]
+    assert storage.get('a') == 'key-a2'
+    assert FileStorage(path).load() == {'a': 'key-a2', 'b': 'key-b'}
+
+
+def test_file_storage_compacts_the_log(tmp_path):
+    path = str(tmp_path / 'db.json')
+    storage = FileStorage(path, compact_ratio=2, compact_min_lines=4)
+
+    for i in range(5):
+        storage.save({'a': f'key-{i}'})
+    storage.save({'b': 'key-b'})
+
+    # Five lines for one user went past both thresholds and were rewritten.
+    assert read_lines(path) == [{'a': 'key-4'}, {'b': 'key-b'}]
+    assert FileStorage(path).load() == {'a': 'key-4', 'b': 'key-b'}
+    assert not (tmp_path / 'db.json.tmp').exists()
+
+
+def test_file_storage_replays_an_existing_log_before_appending(tmp_path):
+    path = str(tmp_path / 'db.json')
+    FileStorage(path).save({'a': 'key-a'})
+
+    storage = FileStorage(path)
+    storage.save({'b': 'key-b'})
+
+    assert storage.get('a') == 'key-a'
+    assert storage.load() == {'a': 'key-a', 'b': 'key-b'}
+
+
+def test_file_storage_without_a_file(tmp_path):
+    storage = FileStorage(str(tmp_path / 'missing.json'))
+
+    assert storage.load() == {}
+    assert storage.get('a') is None
+
+
+def test_mongo_storage():
+    storage = MongoStorage(mongomock.MongoClient().db)
+
+    storage.save({'a': 'key-a'})
+    storage.save({'a': 'key-a2'})
+    storage.save({'b': 'key-b'})
+
+    assert storage.get('a') == 'key-a2'
+    assert storage.get('c') is None
+    assert storage.load() == {'a': 'key-a2', 'b': 'key-b'}
+
+
+class CountingStorage(FileStorage):
+    """
+    A FileStorage counting the lookups that reach it.
+    """
+
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        self.gets = 0
+
+    def get(self, user_id):
+        self.gets += 1
+        return super().get(user_id)
+
+
+def test_facade_caches_lookups_including_misses(tmp_path):
+    backend = CountingStorage(str(tmp_path / 'db.json'))
+    storage = Storage(backend, cache_ttl=60)
+
+    assert storage.get('a') is None
+    assert storage.get('a') is None
+    storage.save({'a': 'key-a'})
+
+    assert storage.get('a') == 'key-a'
+    assert backend.gets == 1
+
+
+def test_facade_sees_saves_by_others_after_invalidation(tmp_path):
+    path = str(tmp_path / 'db.json')
+    storage = Storage(FileStorage(path), cache_ttl=60)
+    storage.get('a')
+    # Saved by another process.
+    storage.storage.save({'a': 'key-a'})
+
+    assert storage.get('a') is None
+    storage.invalidate('a')
+    assert storage.get('a') == 'key-a'
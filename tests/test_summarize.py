@@ -0,0 +1,152 @@
+"""
+test_summarize.py
+"""
+
+import threading
+
+import pytest
+
+from src.memory import SUMMARY_PREFIX, Memory
+from src.summarize import Summarizer
+
+
+class StubModel:
+    """
+    Answers summarizations with `摘要 <n>`, once `release` is set.
+    """
+
+    def __init__(self, blocked=False):
+        self.release = threading.Event()
+        if not blocked:
+            self.release.set()
+        self.requests = []
+
+    def chat_completions(self, messages, model_engine):  # pylint: disable=unused-argument
+        self.requests.append(messages[-1]['content'])
+        self.release.wait(5)
+        content = f'摘要 {len(self.requests)}'
+        return True, {'choices': [{'message': {'role': 'assistant', 'content': content}}]}, None
+
+
+def make_memory(model, memory_message_count=1, **kwargs):
+    summarizer = Summarizer(model, 'gpt-3.5-turbo', **kwargs)
+    return Memory('sys', memory_message_count, summarizer=summarizer, summary_keep_turns=2)
+
+
+def append_turns(memory, user_id, *contents):
+    for i, content in enumerate(contents):
+        memory.append(user_id, 'user' if i % 2 == 0 else 'assistant', content)
+
+
+def contents(memory, user_id):
+    return [message['content'] for message in memory.get(user_id)]
+
+
+def test_summary_replaces_the_older_turns():
+    model = StubModel()
+    memory = make_memory(model)
+
+    append_turns(memory, 'u', 'a', 'b', 'c')
+    memory.summarizer.join()
+
+    assert model.requests == ['對話：\n使用者：a']
+    assert contents(memory, 'u') == ['sys', SUMMARY_PREFIX + '摘要 1', 'b', 'c']
+    assert memory.stats()['summaries'] == 1
+
+
+def test_summary_of_a_reset_conversation_is_stale():
+    model = StubModel(blocked=True)
+    memory = make_memory(model)
+    append_turns(memory, 'u', 'a', 'b', 'c')
+
+    memory.remove('u')
+    memory.append('u', 'user', 'x')
+    model.release.set()
+    memory.summarizer.join()
+
+    assert contents(memory, 'u') == ['sys', 'x']
+    assert memory.stats()['stale_summaries'] == 1
+    assert memory.stats()['summaries'] == 0
+
+
+def test_turns_appended_while_summarizing_are_kept():
+    model = StubModel(blocked=True)
+    memory = make_memory(model, memory_message_count=2)
+    append_turns(memory, 'u', 'a', 'b', 'c', 'd', 'e')
+
+    # The window drops `a`, `b` and `c` were summarized, `f` was not.
+    memory.append('u', 'assistant', 'f')
+    model.release.set()
+    memory.summarizer.join()
+
+    assert model.requests == ['對話：\n使用者：a\n助理：b\n使用者：c']
+    assert contents(memory, 'u') == ['sys', SUMMARY_PREFIX + '摘要 1', 'd', 'e', 'f']
+
+
+def test_summary_of_turns_the_window_dropped():
+    model = StubModel(blocked=True)
+    memory = make_memory(model)
+    append_turns(memory, 'u', 'a', 'b', 'c')
+
+    memory.append('u', 'assistant', 'd')
+    model.release.set()
+    memory.summarizer.join()
+
+    assert contents(memory, 'u') == ['sys', SUMMARY_PREFIX + '摘要 1', 'b', 'c', 'd']
+    assert memory.stats()['summaries'] == 1
+
+
+def test_a_dropped_summarization_is_tried_again():
+    model = StubModel(blocked=True)
+    memory = make_memory(model, max_queue_size=1)
+    append_turns(memory, 'first', 'a', 'b', 'c')
+    # The worker took the first job, the second one fills the queue.
+    while not model.requests:
+        model.release.wait(0.01)
+    append_turns(memory, 'second', 'a', 'b', 'c')
+
+    append_turns(memory, 'third', 'a', 'b', 'c')
+
+    assert memory.summarizer.stats()['dropped'] == 1
+    assert memory.conversations['third'].summarizing is False
+    model.release.set()
+    memory.summarizer.join()
+    assert contents(memory, 'third') == ['sys', 'a', 'b', 'c']
+
+    memory.append('third', 'assistant', 'd')
+    memory.summarizer.join()
+    assert contents(memory, 'third') == ['sys', SUMMARY_PREFIX + '摘要 3', 'c', 'd']
+
+
+def test_submit_does_not_call_back_when_the_queue_is_full():
+    model = StubModel(blocked=True)
+    summarizer = Summarizer(model, 'gpt-3.5-turbo', max_queue_size=1)
+    results = []
+    summarizer.submit(None, [{'role': 'user', 'content': 'a'}], results.append)
+    while not model.requests:
+        model.release.wait(0.01)
+    assert summarizer.submit(None, [{'role': 'user', 'content': 'b'}], results.append)
+
+    assert not summarizer.submit(None, [{'role': 'user', 'content': 'c'}], results.append)
+
+    assert results == []
+    model.release.set()
+    summarizer.join()
+    assert results == ['摘要 1', '摘要 2']
+
+
+@pytest.mark.parametrize('response', [
+    (False, None, 'rate limited'),
+    (True, {'choices': [{'message': {'role': 'assistant', 'content': ' '}}]}, None),
+])
+def test_a_failed_summary_keeps_the_turns(response):
+    model = StubModel()
+    model.chat_completions = lambda messages, model_engine: response
+    memory = make_memory(model)
+
+    append_turns(memory, 'u', 'a', 'b', 'c')
+    memory.summarizer.join()
+
+    assert contents(memory, 'u') == ['sys', 'a', 'b', 'c']
+    assert memory.conversations['u'].summarizing is False
+    assert memory.summarizer.stats()['failed'] == 1
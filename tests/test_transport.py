@@ -0,0 +1,145 @@
+"""
+test_transport.py
+"""
+
+import io
+
+import pytest
+import requests
+
+from src.transport import HTTPTransport
+
+
+def make_response(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(b'')
+    response.headers.update(headers or {})
+    return response
+
+
+class ScriptedSession:
+    """
+    Stands in for `requests.Session`, answering with the scripted outcomes:
+    a status code, a response or an exception to raise.
+    """
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, int):
+            return make_response(outcome)
+        return outcome
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr('src.transport.time.sleep', slept.append)
+    return slept
+
+
+def transport_with(outcomes, **kwargs):
+    transport = HTTPTransport(**kwargs)
+    transport.session = ScriptedSession(outcomes)
+    return transport
+
+
+@pytest.mark.parametrize('status_code', [429, 500, 502, 503, 504])
+def test_retryable_statuses_are_retried(sleeps, status_code):
+    transport = transport_with([status_code, status_code, 200])
+
+    response = transport.request('POST', 'https://api.openai.com/v1/chat/completions')
+
+    assert response.status_code == 200
+    assert len(sleeps) == 2
+    assert transport.stats()['retries'] == 2
+    assert transport.stats()['failures'] == 0
+
+
+def test_other_statuses_are_not_retried(sleeps):
+    transport = transport_with([400])
+
+    assert transport.request('GET', 'https://example.com').status_code == 400
+    assert sleeps == []
+
+
+def test_connection_errors_are_retried(sleeps):
+    transport = transport_with([requests.ConnectionError(), requests.Timeout(), 200])
+
+    assert transport.request('GET', 'https://example.com').status_code == 200
+    assert len(sleeps) == 2
+
+
+def test_the_last_response_is_returned_when_retries_run_out(sleeps):
+    transport = transport_with([503] * 4, max_retries=3)
+
+    assert transport.request('GET', 'https://example.com').status_code == 503
+    assert len(sleeps) == 3
+    assert transport.stats()['failures'] == 1
+
+
+def test_the_last_error_is_raised_when_retries_run_out(sleeps):
+    transport = transport_with([requests.ConnectionError()] * 3, max_retries=2)
+
+    with pytest.raises(requests.ConnectionError):
+        transport.request('GET', 'https://example.com')
+    assert len(sleeps) == 2
+
+
+def test_backoff_is_jittered_and_capped(sleeps, monkeypatch):
+    bounds = []
+    monkeypatch.setattr('src.transport.random.uniform', lambda low, high: bounds.append((low, high)) or high)
+    transport = transport_with([500] * 6, max_retries=5, backoff_base=0.5, backoff_max=3)
+
+    transport.request('GET', 'https://example.com')
+
+    assert bounds[:5] == [(0, 0.5), (0, 1), (0, 2), (0, 3), (0, 3)]
+    assert sleeps == [0.5, 1, 2, 3, 3]
+
+
+def test_full_jitter_stays_within_the_backoff(sleeps):
+    transport = transport_with([500] * 4, max_retries=3, backoff_base=1)
+
+    transport.request('GET', 'https://example.com')
+
+    assert all(0 <= delay <= cap for delay, cap in zip(sleeps, [1, 2, 4]))
+    assert len(set(sleeps)) > 1
+
+
+def test_retry_after_is_honoured(sleeps):
+    transport = transport_with([make_response(429, {'Retry-After': '2'}), 200], backoff_max=8)
+
+    transport.request('GET', 'https://example.com')
+
+    assert sleeps == [2.0]
+
+
+def test_retries_stop_at_the_budget(sleeps):
+    transport = transport_with([make_response(429, {'Retry-After': '5'})] * 3, retry_budget=4)
+
+    assert transport.request('GET', 'https://example.com').status_code == 429
+    assert sleeps == []
+
+
+def test_uploads_are_not_retried(sleeps):
+    transport = transport_with([503])
+
+    response = transport.request('POST', 'https://example.com', files={'file': b'audio'})
+
+    assert response.status_code == 503
+    assert sleeps == []
+
+
+def test_default_timeouts_are_sent():
+    transport = transport_with([200], connect_timeout=1, read_timeout=2)
+
+    transport.request('GET', 'https://example.com')
+
+    assert transport.session.calls[0][2]['timeout'] == (1, 2)
@@ -0,0 +1,41 @@
+"""
+test_utils.py
+"""
+
+from src.utils import group_messages, split_sentences
+
+
+def test_split_sentences_yields_each_sentence_once_it_ends():
+    deltas = iter(['你好', '。今天', '過得', '如何？', '我在', '這裡\n', '陪你'])
+
+    assert next(split_sentences(deltas)) == '你好。'
+    assert list(split_sentences(['你好', '。今天', '過得', '如何？', '我在', '這裡\n', '陪你'])) == \
+        ['你好。', '今天過得如何？', '我在這裡\n', '陪你']
+
+
+def test_split_sentences_keeps_closing_quotes_and_whitespace():
+    assert list(split_sentences(['他說「好累。」 ', '然後 ', 'left. OK'])) == \
+        ['他說「好累。」', ' 然後 left.', ' OK']
+
+
+def test_split_sentences_of_an_empty_stream():
+    assert list(split_sentences([])) == []
+    assert list(split_sentences(['', ''])) == []
+
+
+def test_group_messages_sends_the_first_sentence_alone():
+    sentences = ['第一句。', '二。', '三。', '四。', '五。']
+
+    assert list(group_messages(sentences, chunk_size=4)) == ['第一句。', '二。三。', '四。五。']
+
+
+def test_group_messages_does_not_send_whitespace_as_the_first_message():
+    assert list(group_messages(['\n', '嗨。', '你好。'])) == ['嗨。', '\n你好。']
+
+
+def test_group_messages_respects_the_max_length():
+    messages = list(group_messages(['a' * 12, 'b' * 3], chunk_size=100, max_length=5))
+
+    assert all(len(message) <= 5 for message in messages)
+    assert ''.join(messages) == 'a' * 12 + 'b' * 3
+    assert messages == ['aaaaa', 'aaaaa', 'aabbb']